@@ -0,0 +1,84 @@
+import argparse
+import random
+import re
+import timeit
+
+from formatting import render_chunks, render_markdown
+
+def legacy_clean_text_for_telegram(text: str) -> str:
+    text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
+    text = re.sub(r'\*(.*?)\*', r'\1', text)
+    text = re.sub(r'```[\s\S]*?```', '', text, flags=re.DOTALL)
+    text = re.sub(r'`(.*?)`', r'\1', text)
+    text = re.sub(r'^#+\s*', '', text, flags=re.MULTILINE)
+    text = re.sub(r'^\s*[\*\-]\s', '', text, flags=re.MULTILINE)
+    text = re.sub(r'<[^>]+>', '', text)
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    text = text.strip()
+    return text
+
+def legacy_split_message_text(text: str, limit: int = 4096) -> list:
+    if len(text) <= limit:
+        return [text]
+    parts = []
+    current_part = ""
+    for line in text.split('\n'):
+        if len(current_part) + len(line) + 1 > limit:
+            if current_part:
+                parts.append(current_part)
+            current_part = line
+            while len(current_part) > limit:
+                parts.append(current_part[:limit])
+                current_part = current_part[limit:]
+        else:
+            current_part += ('\n' if current_part else '') + line
+    if current_part:
+        parts.append(current_part)
+    return parts
+
+WORDS = "the model answer token stream context history image voice message user reply format".split()
+
+def sentence(rng: random.Random) -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(6, 18))]
+    for _ in range(rng.randint(0, 3)):
+        index = rng.randrange(len(words))
+        words[index] = rng.choice(["**{}**", "*{}*", "`{}`", "[{0}](https://example.com/{0})", "{} & <{}>"]).format(words[index], words[index])
+    return " ".join(words).capitalize() + "."
+
+def generate_reply(size: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    blocks = []
+    length = 0
+    while length < size:
+        kind = rng.random()
+        if kind < 0.1:
+            block = f"## {sentence(rng)}"
+        elif kind < 0.35:
+            block = "\n".join(f"* {sentence(rng)}" for _ in range(rng.randint(2, 6)))
+        elif kind < 0.5:
+            block = "```python\n" + "\n".join(f"    value_{i} = compute(a < b, c & d)  # {rng.choice(WORDS)}" for i in range(rng.randint(3, 15))) + "\n```"
+        else:
+            block = " ".join(sentence(rng) for _ in range(rng.randint(2, 6)))
+        blocks.append(block)
+        length += len(block) + 2
+    return "\n\n".join(blocks)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the Markdown-to-HTML renderer with the legacy regex cleanup.")
+    parser.add_argument('--sizes', default="2000,16000,64000,256000", help="Comma-separated reply sizes in characters.")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'size':>8} {'legacy ms':>10} {'renderer ms':>12} {'legacy+split':>13} {'render+split':>13} {'chunks':>7}")
+    for size in (int(value) for value in args.sizes.split(',')):
+        text = generate_reply(size)
+        number = max(1, 200000 // size)
+        legacy = min(timeit.repeat(lambda: legacy_clean_text_for_telegram(text), number=number, repeat=args.repeat)) / number
+        renderer = min(timeit.repeat(lambda: render_markdown(text), number=number, repeat=args.repeat)) / number
+        legacy_split = min(timeit.repeat(lambda: legacy_split_message_text(legacy_clean_text_for_telegram(text)), number=number, repeat=args.repeat)) / number
+        render_split = min(timeit.repeat(lambda: render_chunks(text), number=number, repeat=args.repeat)) / number
+        chunks = len(render_chunks(text))
+        print(f"{len(text):>8} {legacy * 1000:>10.3f} {renderer * 1000:>12.3f} {legacy_split * 1000:>13.3f} {render_split * 1000:>13.3f} {chunks:>7}")
+
+if __name__ == '__main__':
+    main()
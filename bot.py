@@ -1,10 +1,12 @@
 import os
+import httpx
 import telegram
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.request import BaseRequest
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, filters, ContextTypes
 import google.generativeai as genai
-from google.generativeai.types import HarmCategory, HarmBlockThreshold, BlockedPromptException
-import re
+from google.generativeai.types import HarmCategory, HarmBlockThreshold, BlockedPromptException, StopCandidateException
+from google.api_core.exceptions import InvalidArgument, ResourceExhausted
 import asyncio
 from PIL import Image
 from io import BytesIO
@@ -12,11 +14,25 @@ import base64
 import logging
 import time
 from dotenv import load_dotenv
-from telegram.constants import ChatAction
-from datetime import datetime, timedelta
+from telegram.constants import ChatAction, ParseMode
+from datetime import timedelta
 import threading
 import sys
 import json
+import hashlib
+import random
+import heapq
+import contextvars
+from bisect import bisect_left
+import signal
+from contextlib import contextmanager
+from functools import partial, wraps
+from urllib.parse import urlparse
+import sqlite3
+import ssl
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from formatting import html_to_text, render_chunks
 
 load_dotenv()
 
@@ -34,6 +50,8 @@ genai.configure(api_key=GEMINI_API_KEY)
 CHAT_HISTORY_DIR = 'chat_histories'
 FULL_CHAT_HISTORY_DIR = 'full_chat_histories'
 FULL_HISTORY_USERS_FILE = 'full_history_users.json'
+HISTORY_BACKEND = os.getenv("HISTORY_BACKEND", "json").lower()
+HISTORY_DB_FILE = os.getenv("HISTORY_DB_FILE", 'chat_histories.db')
 
 os.makedirs(CHAT_HISTORY_DIR, exist_ok=True)
 os.makedirs(FULL_CHAT_HISTORY_DIR, exist_ok=True)
@@ -41,10 +59,117 @@ os.makedirs(FULL_CHAT_HISTORY_DIR, exist_ok=True)
 MAX_MESSAGES_TO_REMEMBER = 10
 MAX_FULL_HISTORY_MESSAGES_TO_REMEMBER = 200
 
+HISTORY_CACHE_SIZE = 1000
+HISTORY_FLUSH_INTERVAL = 2
+HISTORY_COMPACT_INTERVAL = 300
+HISTORY_JOURNAL_MAX_TURNS = 50
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "8000"))
+SUMMARY_MIN_TURNS = 4
+SUMMARY_PROMPT = (
+    "Update the running summary of a conversation between a user and an assistant. "
+    "Keep facts, names, preferences, decisions and open questions; drop small talk. "
+    "Answer with the updated summary only.\n\n"
+    "Current summary:\n{previous_summary}\n\n"
+    "Messages to fold into the summary:\n{conversation}"
+)
+
 INITIAL_HTML_INSTRUCTION = []
 
-text_model = genai.GenerativeModel('gemini-2.5-flash')
-vision_audio_model = genai.GenerativeModel('gemini-2.5-flash')
+MAX_MESSAGE_LENGTH = 4096
+STREAM_RESPONSES = True
+STREAM_EDIT_INTERVAL = 1.5
+STREAM_PLACEHOLDER_TEXT = "…"
+
+INLINE_MEDIA_MAX_BYTES = 4 * 1024 * 1024
+GEMINI_FILE_JANITOR_INTERVAL = 30
+GEMINI_FILE_JANITOR_BATCH_SIZE = 20
+
+PHOTO_TARGET_RESOLUTION = 1024
+PHOTO_MAX_RESOLUTION = 2048
+PHOTO_JPEG_QUALITY = 85
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", "0")) or None
+
+MEDIA_CACHE_MAX_ENTRIES = 500
+MEDIA_CACHE_MAX_BYTES = 64 * 1024 * 1024
+MEDIA_CACHE_TTL = 6 * 3600
+UPLOADED_MEDIA_CACHE_SIZE = 1024
+DOWNLOAD_POOL_SIZE = int(os.getenv("DOWNLOAD_POOL_SIZE", "32"))
+DOWNLOAD_TIMEOUT = 60
+RESPONSE_CACHE_MAX_ENTRIES = 2000
+RESPONSE_CACHE_MAX_BYTES = 16 * 1024 * 1024
+RESPONSE_CACHE_TTL = 3600
+
+MAX_CONCURRENT_UPDATES = 256
+MAX_PENDING_UPDATES_PER_USER = 20
+BURST_WINDOW = float(os.getenv("BURST_WINDOW", "1.0"))
+BURST_MAX_WAIT = float(os.getenv("BURST_MAX_WAIT", "5"))
+BURST_MAX_MESSAGES = 10
+BURST_TYPING_INTERVAL = 4
+MEDIA_GROUP_WINDOW = float(os.getenv("MEDIA_GROUP_WINDOW", "0.8"))
+VOICE_PROMPT = "Transcribe the following voice message, and then respond to its content."
+MAX_CONCURRENT_GEMINI_REQUESTS = int(os.getenv("MAX_CONCURRENT_GEMINI_REQUESTS", "16"))
+GEMINI_REQUESTS_PER_MINUTE = int(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "1000"))
+GEMINI_TOKENS_PER_MINUTE = int(os.getenv("GEMINI_TOKENS_PER_MINUTE", "1000000"))
+GEMINI_MAX_RETRIES = 4
+GEMINI_RETRY_BASE_DELAY = 1
+GEMINI_RETRY_MAX_DELAY = 30
+MEDIA_PART_TOKEN_ESTIMATE = 258
+
+SHUTDOWN_DRAIN_TIMEOUT = 60
+
+TELEGRAM_GLOBAL_MESSAGES_PER_SECOND = 30
+TELEGRAM_CHAT_MESSAGES_PER_SECOND = 1
+TELEGRAM_CHAT_BURST = 3
+OUTBOUND_PRIORITY_REPLY = 0
+OUTBOUND_PRIORITY_EDIT = 1
+OUTBOUND_PRIORITY_STATUS = 2
+OUTBOUND_PRIORITY_NAMES = {OUTBOUND_PRIORITY_REPLY: 'reply', OUTBOUND_PRIORITY_EDIT: 'edit', OUTBOUND_PRIORITY_STATUS: 'status'}
+OUTBOUND_STATUS_DROP_BACKLOG = 100
+OUTBOUND_MAX_ATTEMPTS = 3
+OUTBOUND_MAX_IDLE_CHATS = 10000
+
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "https://api.telegram.org/bot")
+TELEGRAM_BASE_FILE_URL = os.getenv("TELEGRAM_BASE_FILE_URL", "https://api.telegram.org/file/bot")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = urlparse(WEBHOOK_URL).path or "/"
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN") or None
+WEBHOOK_CERT = os.getenv("WEBHOOK_CERT", "")
+WEBHOOK_KEY = os.getenv("WEBHOOK_KEY", "")
+WEBHOOK_MAX_CONNECTIONS = 100
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", str(os.cpu_count() or 1)))
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", "9100"))
+WORKER_HEALTH_CHECK_INTERVAL = 5
+WORKER_HEALTH_CHECK_TIMEOUT = 2
+WORKER_MIN_UPTIME = 30
+WORKER_MAX_RESPAWN_DELAY = 60
+FULL_HISTORY_REFRESH_INTERVAL = 30
+HTTP_MAX_BODY_BYTES = 1024 * 1024
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+WORKER_INDEX = None
+
+TEXT_MODEL_NAME = os.getenv("TEXT_MODEL", "gemini-2.5-flash")
+SHORT_TEXT_MODEL_NAME = os.getenv("SHORT_TEXT_MODEL", "")
+VISION_AUDIO_MODEL_NAME = os.getenv("VISION_AUDIO_MODEL", "gemini-2.5-flash")
+SHORT_TEXT_MAX_CHARS = int(os.getenv("SHORT_TEXT_MAX_CHARS", "200"))
+
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+HEDGE_DEFAULT_DELAY = 5
+HEDGE_MIN_DELAY = 0.5
+HEDGE_MIN_SAMPLES = 20
+HEDGE_BUDGET = 0.1
+MODEL_LATENCY_SAMPLES = 200
+BREAKER_WINDOW = 20
+BREAKER_MIN_CALLS = 10
+BREAKER_FAILURE_RATIO = 0.5
+BREAKER_SLOW_SECONDS = 30
+BREAKER_COOLDOWN = 30
 
 safety_settings = {
     HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
@@ -53,26 +178,210 @@ safety_settings = {
     HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
 }
 
-user_chat_sessions = {}
-user_last_active = {}
 SESSION_EXPIRATION_TIME = timedelta(hours=1)
+SESSION_EXPIRY_CHECK_INTERVAL = 60
+MAX_RESIDENT_SESSIONS = 2000
 
 RATE_LIMIT_SECONDS = 10
 RATE_LIMIT_MESSAGES = 1
 COOLDOWN_SECONDS = 30
 REPEAT_MESSAGE_THRESHOLD = 2
-user_activity = {}
+RATE_LIMIT_IDLE_SECONDS = 3600
+RATE_LIMIT_EVICTION_INTERVAL = 60
+RATE_LIMIT_WHITELIST = {int(user_id) for user_id in os.getenv("RATE_LIMIT_WHITELIST", "").split(",") if user_id.strip()}
+RATE_LIMIT_TIERS = {
+    'default': (RATE_LIMIT_MESSAGES, RATE_LIMIT_SECONDS),
+    'whitelist': (RATE_LIMIT_MESSAGES * 5, RATE_LIMIT_SECONDS),
+    'admin': None,
+}
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()
+RATE_LIMIT_DB_FILE = os.getenv("RATE_LIMIT_DB_FILE", 'rate_limits.db')
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+current_handler = contextvars.ContextVar('current_handler', default='other')
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        target = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return 0.0
+
+class Metrics:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name: str, labels: tuple, value: float):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def increment(self, name: str, labels: tuple = (), amount: float = 1):
+        self.counters[(name, labels)] = self.counters.get((name, labels), 0) + amount
+
+    def gauge(self, name: str, read):
+        self.gauges[name] = read
+
+    @contextmanager
+    def timer(self, stage: str, model: str = ''):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            labels = (('handler', current_handler.get()), ('stage', stage), ('model', model))
+            self.observe('bot_stage_seconds', labels, time.perf_counter() - started)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (histogram_name, labels), histogram in sorted(self.histograms.items()):
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram.total}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (counter_name, labels), value in sorted(self.counters.items()):
+                if counter_name == name:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+        for name, read in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        lines = ["Stage latency (count, p50, p95, avg):"]
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            label_text = "/".join(value for _, value in labels if value)
+            lines.append(f"{name.removeprefix('bot_').removesuffix('_seconds')} {label_text}: {histogram.count}, "
+                         f"{histogram.quantile(0.5):.3g}s, {histogram.quantile(0.95):.3g}s, {histogram.total / histogram.count:.3g}s")
+        if self.counters:
+            lines.append("Counters:")
+            for (name, labels), value in sorted(self.counters.items()):
+                label_text = ",".join(f"{key}={value}" for key, value in labels)
+                lines.append(f"{name.removeprefix('bot_')}{' ' + label_text if label_text else ''}: {value:g}")
+        lines.append("Gauges: " + ", ".join(f"{name.removeprefix('bot_')}={read()}" for name, read in sorted(self.gauges.items())))
+        return "\n".join(lines)
+
+def escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label_value(value)}"' for key, value in labels) + "}"
+
+metrics = Metrics(METRICS_BUCKETS)
+
+def instrumented(handler_name: str):
+    def decorate(handler):
+        @wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+            current_handler.set(handler_name)
+            metrics.increment('bot_updates_total', (('handler', handler_name),))
+            with metrics.timer('total'):
+                await handler(update, context)
+        return wrapper
+    return decorate
+
+def model_label(model) -> str:
+    return getattr(model, 'model_name', 'unknown').removeprefix('models/')
+
 def get_history_file_path(user_id: int) -> str:
     return os.path.join(CHAT_HISTORY_DIR, f'{user_id}_history.json')
 
 def get_full_history_file_path(user_id: int) -> str:
     return os.path.join(FULL_CHAT_HISTORY_DIR, f'{user_id}_full_history.json')
 
-def load_full_history_users() -> set:
+def get_history_journal_path(file_path: str) -> str:
+    return f'{file_path}.journal'
+
+def get_summary_file_path(file_path: str) -> str:
+    return f'{os.path.splitext(file_path)[0]}_summary.json'
+
+def get_history_limit(full: bool) -> int:
+    return MAX_FULL_HISTORY_MESSAGES_TO_REMEMBER if full else MAX_MESSAGES_TO_REMEMBER * 2
+
+def write_json_atomic(file_path: str, data):
+    tmp_path = f'{file_path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+def read_history_file(file_path: str) -> list:
+    history = []
+    if os.path.exists(file_path):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            history = json.load(f)
+
+    journal_path = get_history_journal_path(file_path)
+    if not os.path.exists(journal_path):
+        return history
+    if os.path.exists(file_path) and os.stat(journal_path).st_mtime_ns < os.stat(file_path).st_mtime_ns:
+        return history
+    with open(journal_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                history.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.warning(f"Ignoring torn journal entry in {journal_path}.")
+                break
+    return history
+
+def write_history_snapshot(file_path: str, history: list):
+    write_json_atomic(file_path, history)
+    journal_path = get_history_journal_path(file_path)
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+
+def append_history_journal(file_path: str, turns: list):
+    with open(get_history_journal_path(file_path), 'a', encoding='utf-8') as f:
+        for turn in turns:
+            f.write(json.dumps(turn, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def delete_history_files(file_path: str) -> bool:
+    journal_path = get_history_journal_path(file_path)
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+    if os.path.exists(file_path):
+        os.remove(file_path)
+        return True
+    return False
+
+def read_full_history_users_file() -> set:
     if os.path.exists(FULL_HISTORY_USERS_FILE):
         try:
             with open(FULL_HISTORY_USERS_FILE, 'r', encoding='utf-8') as f:
@@ -82,434 +391,2439 @@ def load_full_history_users() -> set:
             return set()
     return set()
 
-def save_full_history_users(users: set):
-    with open(FULL_HISTORY_USERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(list(users), f, ensure_ascii=False, indent=2)
+class HistoryBackend:
+    def load_history(self, user_id: int, full: bool) -> list:
+        raise NotImplementedError
 
-FULL_HISTORY_ENABLED_USERS = load_full_history_users()
+    def append_history(self, batch: dict):
+        raise NotImplementedError
 
-def load_chat_history(user_id: int) -> list:
-    file_path = get_history_file_path(user_id)
-    if os.path.exists(file_path):
+    def compact_history(self, snapshots: dict):
+        raise NotImplementedError
+
+    def clear_history(self, user_id: int):
+        raise NotImplementedError
+
+    def load_summary(self, user_id: int, full: bool) -> str:
+        raise NotImplementedError
+
+    def save_summary(self, user_id: int, full: bool, summary: str):
+        raise NotImplementedError
+
+    def load_full_history_users(self) -> set:
+        raise NotImplementedError
+
+    def set_full_history_user(self, user_id: int, enabled: bool):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class JsonHistoryBackend(HistoryBackend):
+    def get_file_path(self, user_id: int, full: bool) -> str:
+        return get_full_history_file_path(user_id) if full else get_history_file_path(user_id)
+
+    def load_history(self, user_id: int, full: bool) -> list:
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return read_history_file(self.get_file_path(user_id, full))
         except json.JSONDecodeError as e:
-            logger.error(f"Error decoding JSON for user {user_id}: {e}. Starting new history.")
+            logger.error(f"Error decoding {'full history ' if full else ''}JSON for user {user_id}: {e}. Starting new history.")
             return []
-    return []
 
-def save_chat_history(user_id: int, history: list):
-    file_path = get_history_file_path(user_id)
-    if len(history) > MAX_MESSAGES_TO_REMEMBER * 2:
-        history = history[-MAX_MESSAGES_TO_REMEMBER * 2:]
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(history, f, ensure_ascii=False, indent=2)
+    def append_history(self, batch: dict):
+        for (user_id, full), turns in batch.items():
+            append_history_journal(self.get_file_path(user_id, full), turns)
 
-def load_full_chat_history(user_id: int) -> list:
-    file_path = get_full_history_file_path(user_id)
-    if os.path.exists(file_path):
+    def compact_history(self, snapshots: dict):
+        for (user_id, full), history in snapshots.items():
+            write_history_snapshot(self.get_file_path(user_id, full), history)
+
+    def clear_history(self, user_id: int):
+        for full, label in ((False, "standard"), (True, "full")):
+            file_path = self.get_file_path(user_id, full)
+            summary_path = get_summary_file_path(file_path)
+            if os.path.exists(summary_path):
+                os.remove(summary_path)
+            if delete_history_files(file_path):
+                logger.info(f"Deleted {label} chat history file for user {user_id}.")
+
+    def load_summary(self, user_id: int, full: bool) -> str:
+        summary_path = get_summary_file_path(self.get_file_path(user_id, full))
+        if not os.path.exists(summary_path):
+            return ""
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with open(summary_path, 'r', encoding='utf-8') as f:
+                return json.load(f).get("summary", "")
         except json.JSONDecodeError as e:
-            logger.error(f"Error decoding full history JSON for user {user_id}: {e}. Starting new full history.")
+            logger.error(f"Error decoding history summary for user {user_id}: {e}. Starting without summary.")
+            return ""
+
+    def save_summary(self, user_id: int, full: bool, summary: str):
+        write_json_atomic(get_summary_file_path(self.get_file_path(user_id, full)), {"summary": summary})
+
+    def load_full_history_users(self) -> set:
+        return read_full_history_users_file()
+
+    def set_full_history_user(self, user_id: int, enabled: bool):
+        users = read_full_history_users_file()
+        if enabled:
+            users.add(user_id)
+        else:
+            users.discard(user_id)
+        write_json_atomic(FULL_HISTORY_USERS_FILE, list(users))
+
+class SqliteHistoryBackend(HistoryBackend):
+    def __init__(self, db_path: str):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "turn INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "user_id INTEGER NOT NULL, "
+                "is_full INTEGER NOT NULL, "
+                "content TEXT NOT NULL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS idx_messages_user_turn ON messages (user_id, is_full, turn)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS full_history_users (user_id INTEGER PRIMARY KEY)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS summaries ("
+                "user_id INTEGER NOT NULL, "
+                "is_full INTEGER NOT NULL, "
+                "summary TEXT NOT NULL, "
+                "PRIMARY KEY (user_id, is_full))"
+            )
+
+    def load_history(self, user_id: int, full: bool) -> list:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT content FROM messages WHERE user_id = ? AND is_full = ? ORDER BY turn DESC LIMIT ?",
+                (user_id, int(full), get_history_limit(full)),
+            ).fetchall()
+        return [json.loads(content) for (content,) in reversed(rows)]
+
+    def append_history(self, batch: dict):
+        rows = [
+            (user_id, int(full), json.dumps(turn, ensure_ascii=False))
+            for (user_id, full), turns in batch.items()
+            for turn in turns
+        ]
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT INTO messages (user_id, is_full, content) VALUES (?, ?, ?)", rows)
+
+    def compact_history(self, snapshots: dict):
+        with self.lock, self.connection:
+            for (user_id, full), history in snapshots.items():
+                self.connection.execute(
+                    "DELETE FROM messages WHERE user_id = ? AND is_full = ? AND turn NOT IN "
+                    "(SELECT turn FROM messages WHERE user_id = ? AND is_full = ? ORDER BY turn DESC LIMIT ?)",
+                    (user_id, int(full), user_id, int(full), len(history)),
+                )
+
+    def clear_history(self, user_id: int):
+        with self.lock, self.connection:
+            deleted = self.connection.execute("DELETE FROM messages WHERE user_id = ?", (user_id,)).rowcount
+            self.connection.execute("DELETE FROM summaries WHERE user_id = ?", (user_id,))
+        logger.info(f"Deleted {deleted} stored chat messages for user {user_id}.")
+
+    def load_summary(self, user_id: int, full: bool) -> str:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT summary FROM summaries WHERE user_id = ? AND is_full = ?", (user_id, int(full))
+            ).fetchone()
+        return row[0] if row else ""
+
+    def save_summary(self, user_id: int, full: bool, summary: str):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO summaries (user_id, is_full, summary) VALUES (?, ?, ?)",
+                (user_id, int(full), summary),
+            )
+
+    def load_full_history_users(self) -> set:
+        with self.lock:
+            return {user_id for (user_id,) in self.connection.execute("SELECT user_id FROM full_history_users")}
+
+    def set_full_history_user(self, user_id: int, enabled: bool):
+        with self.lock, self.connection:
+            if enabled:
+                self.connection.execute("INSERT OR IGNORE INTO full_history_users (user_id) VALUES (?)", (user_id,))
+            else:
+                self.connection.execute("DELETE FROM full_history_users WHERE user_id = ?", (user_id,))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def create_history_backend() -> HistoryBackend:
+    if HISTORY_BACKEND == 'sqlite':
+        return SqliteHistoryBackend(HISTORY_DB_FILE)
+    if HISTORY_BACKEND != 'json':
+        raise ValueError(f"Unknown HISTORY_BACKEND '{HISTORY_BACKEND}'. Use 'json' or 'sqlite'.")
+    return JsonHistoryBackend()
+
+history_backend = create_history_backend()
+
+def load_full_history_users() -> set:
+    return history_backend.load_full_history_users()
+
+def set_full_history_user(user_id: int, enabled: bool):
+    history_backend.set_full_history_user(user_id, enabled)
+
+FULL_HISTORY_ENABLED_USERS = load_full_history_users()
+
+def load_chat_history(user_id: int) -> list:
+    return history_backend.load_history(user_id, False)
+
+def load_full_chat_history(user_id: int) -> list:
+    return history_backend.load_history(user_id, True)
+
+def load_history_with_summary(user_id: int, full: bool) -> tuple:
+    history = load_full_chat_history(user_id) if full else load_chat_history(user_id)
+    return history, history_backend.load_summary(user_id, full)
+
+def save_history_summary(user_id: int, full: bool, summary: str):
+    history_backend.save_summary(user_id, full, summary)
+
+def migrate_json_history_to_sqlite():
+    json_backend = JsonHistoryBackend()
+    sqlite_backend = SqliteHistoryBackend(HISTORY_DB_FILE)
+    imported = 0
+    for directory, full, suffix in ((CHAT_HISTORY_DIR, False, '_history.json'), (FULL_CHAT_HISTORY_DIR, True, '_full_history.json')):
+        batch = {}
+        for file_name in os.listdir(directory):
+            if not file_name.endswith(suffix):
+                continue
+            try:
+                user_id = int(file_name[:-len(suffix)])
+            except ValueError:
+                continue
+            batch[(user_id, full)] = json_backend.load_history(user_id, full)[-get_history_limit(full):]
+            summary = json_backend.load_summary(user_id, full)
+            if summary:
+                sqlite_backend.save_summary(user_id, full, summary)
+        with sqlite_backend.lock, sqlite_backend.connection:
+            sqlite_backend.connection.executemany(
+                "DELETE FROM messages WHERE user_id = ? AND is_full = ?",
+                [(user_id, int(full)) for user_id, _ in batch],
+            )
+        sqlite_backend.append_history(batch)
+        imported += len(batch)
+        logger.info(f"Imported {len(batch)} {'full' if full else 'standard'} chat histories from {directory}.")
+    for user_id in json_backend.load_full_history_users():
+        sqlite_backend.set_full_history_user(user_id, True)
+    sqlite_backend.close()
+    logger.info(f"Migration finished: {imported} chat histories imported into {HISTORY_DB_FILE}.")
+
+class HistoryStore:
+    def __init__(self, max_conversations: int):
+        self.max_conversations = max_conversations
+        self.conversations = OrderedDict()
+        self.token_counts = {}
+        self.summaries = {}
+        self.pending = {}
+        self.writing = set()
+        self.journal_sizes = {}
+        self.rewrites = set()
+        self.last_compaction = time.monotonic()
+        self.io_lock = None
+        self.flush_task = None
+
+    def get_key(self, user_id: int) -> tuple:
+        return (user_id, user_id in FULL_HISTORY_ENABLED_USERS)
+
+    async def start(self):
+        self.io_lock = asyncio.Lock()
+        self.flush_task = asyncio.create_task(self.flush_loop())
+
+    async def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            try:
+                await self.flush_task
+            except asyncio.CancelledError:
+                pass
+            self.flush_task = None
+        await self.flush(compact=True)
+
+    async def ensure_loaded(self, user_id: int) -> tuple:
+        key = self.get_key(user_id)
+        if key not in self.conversations:
+            history, summary = await asyncio.to_thread(load_history_with_summary, *key)
+            if key not in self.conversations:
+                history = history[-get_history_limit(key[1]):]
+                self.conversations[key] = history
+                self.token_counts[key] = [estimate_tokens([turn]) for turn in history]
+                self.summaries[key] = summary
+        self.conversations.move_to_end(key)
+        self.evict(key)
+        return key
+
+    async def load(self, user_id: int) -> list:
+        key = await self.ensure_loaded(user_id)
+        return list(self.conversations[key])
+
+    async def load_context(self, user_id: int) -> list:
+        key = await self.ensure_loaded(user_id)
+        history = self.conversations[key]
+        return summary_turns(self.summaries[key]) + history[self.get_context_start(key):]
+
+    def get_context_start(self, key: tuple) -> int:
+        history = self.conversations[key]
+        counts = self.token_counts[key]
+        start = len(history)
+        total = 0
+        while start > 0 and total + counts[start - 1] <= CONTEXT_TOKEN_BUDGET:
+            start -= 1
+            total += counts[start]
+        while start < len(history) and history[start].get("role") != "user":
+            start += 1
+        return start
+
+    def get_overflow(self, user_id: int) -> list:
+        key = self.get_key(user_id)
+        if key not in self.conversations:
             return []
-    return []
-
-def save_full_chat_history(user_id: int, history: list):
-    file_path = get_full_history_file_path(user_id)
-    if len(history) > MAX_FULL_HISTORY_MESSAGES_TO_REMEMBER:
-        history = history[-MAX_FULL_HISTORY_MESSAGES_TO_REMEMBER:]
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(history, f, ensure_ascii=False, indent=2)
-
-def clean_text_for_telegram(text: str) -> str:
-    text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
-    text = re.sub(r'\*(.*?)\*', r'\1', text)
-    text = re.sub(r'```[\s\S]*?```', '', text, flags=re.DOTALL)
-    text = re.sub(r'`(.*?)`', r'\1', text)
-    text = re.sub(r'^#+\s*', '', text, flags=re.MULTILINE)
-    text = re.sub(r'^\s*[\*\-]\s', '', text, flags=re.MULTILINE)
-    text = re.sub(r'<[^>]+>', '', text)
-    text = re.sub(r'\n{3,}', '\n\n', text)
-    text = text.strip()
-    return text
-
-async def cleanup_old_sessions():
-    now = datetime.now()
-    expired_users = [
-        user_id for user_id, last_active_time in user_last_active.items()
-        if now - last_active_time > SESSION_EXPIRATION_TIME
+        return list(self.conversations[key][:self.get_context_start(key)])
+
+    async def append(self, user_id: int, turns: list):
+        key = await self.ensure_loaded(user_id)
+        history = self.conversations[key]
+        counts = self.token_counts[key]
+        history.extend(turns)
+        counts.extend(estimate_tokens([turn]) for turn in turns)
+        excess = len(history) - get_history_limit(key[1])
+        if excess > 0:
+            del history[:excess]
+            del counts[:excess]
+        self.pending.setdefault(key, []).extend(turns)
+
+    async def apply_summary(self, user_id: int, summary: str, summarized_turns: list) -> bool:
+        key = await self.ensure_loaded(user_id)
+        async with self.io_lock:
+            history = self.conversations.get(key)
+            if history is None or history[:len(summarized_turns)] != summarized_turns:
+                return False
+            self.summaries[key] = summary
+            del history[:len(summarized_turns)]
+            del self.token_counts[key][:len(summarized_turns)]
+            self.rewrites.add(key)
+            try:
+                await asyncio.to_thread(save_history_summary, *key, summary)
+            except Exception:
+                self.rewrites.discard(key)
+                raise
+        return True
+
+    async def clear(self, user_id: int):
+        async with self.io_lock:
+            for key in ((user_id, False), (user_id, True)):
+                self.forget(key)
+                self.pending.pop(key, None)
+                self.journal_sizes.pop(key, None)
+                self.rewrites.discard(key)
+            await asyncio.to_thread(history_backend.clear_history, user_id)
+
+    def forget(self, key: tuple):
+        self.conversations.pop(key, None)
+        self.token_counts.pop(key, None)
+        self.summaries.pop(key, None)
+
+    def evict(self, keep: tuple):
+        for key in list(self.conversations):
+            if len(self.conversations) <= self.max_conversations:
+                break
+            if key != keep and key not in self.pending and key not in self.writing and key not in self.rewrites:
+                self.forget(key)
+
+    async def flush(self, compact: bool = False):
+        async with self.io_lock:
+            pending, self.pending = self.pending, {}
+            self.writing = set(pending)
+            try:
+                if pending:
+                    await asyncio.to_thread(history_backend.append_history, pending)
+            except Exception as e:
+                logger.error(f"Error writing history journal: {e}", exc_info=True)
+                for key, turns in pending.items():
+                    self.pending[key] = turns + self.pending.get(key, [])
+                return
+            finally:
+                self.writing = set()
+
+            for key, turns in pending.items():
+                self.journal_sizes[key] = self.journal_sizes.get(key, 0) + len(turns)
+
+            if time.monotonic() - self.last_compaction >= HISTORY_COMPACT_INTERVAL:
+                compact = True
+                self.last_compaction = time.monotonic()
+
+            snapshots = {}
+            for key in set(self.journal_sizes) | self.rewrites:
+                size = self.journal_sizes.get(key, 0)
+                if key not in self.conversations or not (compact or key in self.rewrites or size >= HISTORY_JOURNAL_MAX_TURNS):
+                    continue
+                history = self.conversations[key]
+                snapshots[key] = history[:max(0, len(history) - len(self.pending.get(key, [])))]
+                self.journal_sizes.pop(key, None)
+                self.rewrites.discard(key)
+            if snapshots:
+                await asyncio.to_thread(self.write_snapshots, snapshots)
+
+    def write_snapshots(self, snapshots: dict):
+        try:
+            history_backend.compact_history({
+                (user_id, full): history[-get_history_limit(full):]
+                for (user_id, full), history in snapshots.items()
+            })
+        except Exception as e:
+            logger.error(f"Error compacting chat history: {e}", exc_info=True)
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(HISTORY_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing chat history: {e}", exc_info=True)
+
+history_store = HistoryStore(HISTORY_CACHE_SIZE)
+
+class SessionManager:
+    def __init__(self, max_sessions: int, expiration: timedelta):
+        self.max_sessions = max_sessions
+        self.expiration = expiration.total_seconds()
+        self.sessions = OrderedDict()
+        self.expires_at = {}
+        self.expiry_heap = []
+
+    def get(self, user_id: int, model, history: list):
+        session = self.sessions.get(user_id)
+        if session is None or len(session.history) != len(history):
+            session = model.start_chat(history=history)
+        elif session.model is not model:
+            session = model.start_chat(history=session.history)
+        self.touch(user_id, session)
+        return session
+
+    def record_turn(self, user_id: int, turns: list, session=None):
+        if session is None:
+            session = self.sessions.get(user_id)
+            if session is None:
+                return
+            history = session.history
+        else:
+            history = session.history[:-len(turns)]
+        prefix = len(INITIAL_HTML_INSTRUCTION)
+        recent = (history[prefix:] + turns)[-get_history_limit(user_id in FULL_HISTORY_ENABLED_USERS):]
+        session.history = history[:prefix] + recent
+        self.touch(user_id, session)
+
+    def touch(self, user_id: int, session):
+        self.sessions[user_id] = session
+        self.sessions.move_to_end(user_id)
+        expires_at = time.monotonic() + self.expiration
+        self.expires_at[user_id] = expires_at
+        heapq.heappush(self.expiry_heap, (expires_at, user_id))
+        while len(self.sessions) > self.max_sessions:
+            evicted_user_id, _ = self.sessions.popitem(last=False)
+            del self.expires_at[evicted_user_id]
+            logger.info(f"Evicted least recently used session for user {evicted_user_id}.")
+
+    def drop(self, user_id: int):
+        self.sessions.pop(user_id, None)
+        self.expires_at.pop(user_id, None)
+
+    def clear(self):
+        self.sessions.clear()
+        self.expires_at.clear()
+        self.expiry_heap = []
+
+    def expire(self) -> int:
+        now = time.monotonic()
+        expired = 0
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expires_at, user_id = heapq.heappop(self.expiry_heap)
+            if self.expires_at.get(user_id) == expires_at:
+                self.drop(user_id)
+                expired += 1
+        if len(self.expiry_heap) > 4 * len(self.expires_at) + 64:
+            self.expiry_heap = [(expires_at, user_id) for user_id, expires_at in self.expires_at.items()]
+            heapq.heapify(self.expiry_heap)
+        return expired
+
+session_manager = SessionManager(MAX_RESIDENT_SESSIONS, SESSION_EXPIRATION_TIME)
+
+async def expire_sessions(context: ContextTypes.DEFAULT_TYPE) -> None:
+    expired = session_manager.expire()
+    if expired:
+        logger.info(f"Expired {expired} idle chat sessions, {len(session_manager.sessions)} still resident.")
+
+def summary_turns(summary: str) -> list:
+    if not summary:
+        return []
+    return [
+        {"role": "user", "parts": [f"Summary of our earlier conversation:\n{summary}"]},
+        {"role": "model", "parts": ["Understood, I will keep that context in mind."]},
     ]
-    for user_id in expired_users:
-        if user_id in user_chat_sessions:
-            del user_chat_sessions[user_id]
-        if user_id in user_last_active:
-            del user_last_active[user_id]
-        logger.info(f"Cleaned up in-memory session for user {user_id}")
+
+def format_turns_for_summary(turns: list) -> str:
+    return "\n".join(
+        f"{'User' if turn.get('role') == 'user' else 'Assistant'}: {' '.join(str(part) for part in turn.get('parts', []))}"
+        for turn in turns
+    )
+
+summary_tasks = {}
+
+async def summarize_history(user_id: int):
+    overflow = history_store.get_overflow(user_id)
+    if len(overflow) < SUMMARY_MIN_TURNS:
+        return
+    previous_summary = history_store.summaries.get(history_store.get_key(user_id))
+    prompt = SUMMARY_PROMPT.format(
+        previous_summary=previous_summary or "(none)",
+        conversation=format_turns_for_summary(overflow),
+    )
+    response = await gemini_scheduler.run(
+        lambda: text_model.generate_content_async(prompt, safety_settings=safety_settings),
+        estimate_tokens([prompt]),
+    )
+    if await history_store.apply_summary(user_id, response.text.strip(), overflow):
+        session_manager.drop(user_id)
+        logger.info(f"Summarized {len(overflow)} older messages for user {user_id}.")
+
+def schedule_summary(user_id: int):
+    if user_id in summary_tasks or len(history_store.get_overflow(user_id)) < SUMMARY_MIN_TURNS:
+        return
+    task = asyncio.create_task(summarize_history(user_id))
+    summary_tasks[user_id] = task
+    lifecycle.track_task(task)
+    task.add_done_callback(lambda t: finish_summary(user_id, t))
+
+def finish_summary(user_id: int, task: asyncio.Task):
+    summary_tasks.pop(user_id, None)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Error summarizing history for user {user_id}: {task.exception()}")
+
+async def save_turn(user_id: int, turns: list, chat_session=None):
+    await history_store.append(user_id, turns)
+    session_manager.record_turn(user_id, turns, chat_session)
+    schedule_summary(user_id)
+
+def queue_html_reply(message, html: str) -> asyncio.Future:
+    async def request():
+        try:
+            return await message.reply_text(html, parse_mode=ParseMode.HTML)
+        except telegram.error.BadRequest as e:
+            logger.warning(f"Telegram rejected formatted reply, sending plain text: {e}")
+            return await message.reply_text(html_to_text(html))
+
+    return outbox.enqueue(message.chat_id, request)
+
+async def reply_html(message, html: str):
+    return await asyncio.shield(queue_html_reply(message, html))
+
+async def edit_html(message, html: str):
+    async def request():
+        try:
+            return await message.edit_text(html, parse_mode=ParseMode.HTML)
+        except telegram.error.BadRequest as e:
+            if "not modified" in str(e):
+                return message
+            logger.warning(f"Telegram rejected formatted edit, using plain text: {e}")
+            return await message.edit_text(html_to_text(html))
+
+    return await outbox.submit(message.chat_id, request, OUTBOUND_PRIORITY_EDIT, key=('edit', message.chat_id, message.message_id))
 
 async def send_long_message(update: Update, text: str):
-    MAX_MESSAGE_LENGTH = 4096
-    if len(text) <= MAX_MESSAGE_LENGTH:
+    parts = [queue_html_reply(update.message, part) for part in render_chunks(text, MAX_MESSAGE_LENGTH)]
+    for index, result in enumerate(await asyncio.gather(*parts, return_exceptions=True)):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to send message part {index + 1}/{len(parts)} for user {update.message.from_user.id}: {result}")
+
+def estimate_tokens(contents) -> int:
+    total = 0
+    for item in contents:
+        if isinstance(item, str):
+            total += len(item) // 4 + 1
+        elif isinstance(item, dict):
+            total += estimate_tokens(item['parts']) if 'parts' in item else MEDIA_PART_TOKEN_ESTIMATE
+        elif isinstance(item, (list, tuple)):
+            total += estimate_tokens(item)
+        elif hasattr(item, 'parts'):
+            total += estimate_tokens(item.parts)
+        elif getattr(item, 'text', ''):
+            total += len(item.text) // 4 + 1
+        else:
+            total += MEDIA_PART_TOKEN_ESTIMATE
+    return total
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay_for(self, amount: float) -> float:
+        self.refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        self.refill()
+        self.tokens -= amount
+
+class OutboundJob:
+    def __init__(self, chat_id: int, request, priority: int, sequence: int, key):
+        self.chat_id = chat_id
+        self.request = request
+        self.priority = priority
+        self.sequence = sequence
+        self.key = key
+        self.future = asyncio.get_running_loop().create_future()
+        self.attempts = 0
+        self.dropped = False
+        self.enqueued_at = time.monotonic()
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+class OutboundQueue:
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chats = {}
+        self.chat_buckets = {}
+        self.paused_until = {}
+        self.pending_keys = {}
+        self.busy = set()
+        self.ready = []
+        self.delayed = []
+        self.sequence = 0
+        self.pending = 0
+        self.wakeup = None
+        self.task = None
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        for jobs in self.chats.values():
+            for job in jobs:
+                if not job.future.done():
+                    job.future.cancel()
+        self.chats.clear()
+        self.pending = 0
+
+    def enqueue(self, chat_id: int, request, priority: int = OUTBOUND_PRIORITY_REPLY, key=None) -> asyncio.Future:
+        if self.task is None:
+            return asyncio.ensure_future(request())
+        if priority == OUTBOUND_PRIORITY_STATUS and (self.pending >= OUTBOUND_STATUS_DROP_BACKLOG or self.has_pending_reply(chat_id)):
+            logger.debug(f"Dropped status message for chat {chat_id} under outbound pressure.")
+            metrics.increment('bot_telegram_status_dropped_total')
+            dropped = asyncio.get_running_loop().create_future()
+            dropped.set_result(None)
+            return dropped
+
+        existing = self.pending_keys.get(key) if key is not None else None
+        if existing is not None:
+            existing.request = request
+            return existing.future
+
+        self.sequence += 1
+        job = OutboundJob(chat_id, request, priority, self.sequence, key)
+        jobs = self.chats.setdefault(chat_id, [])
+        if priority == OUTBOUND_PRIORITY_REPLY:
+            for queued in jobs:
+                if queued.priority == OUTBOUND_PRIORITY_STATUS and not queued.dropped:
+                    self.drop(queued)
+        heapq.heappush(jobs, job)
+        self.pending += 1
+        if key is not None:
+            self.pending_keys[key] = job
+        if chat_id not in self.busy:
+            heapq.heappush(self.ready, (job.priority, job.sequence, chat_id))
+        self.wakeup.set()
+        return job.future
+
+    async def submit(self, chat_id: int, request, priority: int = OUTBOUND_PRIORITY_REPLY, key=None):
+        return await asyncio.shield(self.enqueue(chat_id, request, priority, key))
+
+    def has_pending_reply(self, chat_id: int) -> bool:
+        return any(not job.dropped and job.priority != OUTBOUND_PRIORITY_STATUS for job in self.chats.get(chat_id, ()))
+
+    def drop(self, job: OutboundJob):
+        job.dropped = True
+        self.pending -= 1
+        self.forget_key(job)
+        if not job.future.done():
+            job.future.set_result(None)
+
+    def forget_key(self, job: OutboundJob):
+        if job.key is not None and self.pending_keys.get(job.key) is job:
+            del self.pending_keys[job.key]
+
+    def head(self, chat_id: int):
+        jobs = self.chats.get(chat_id)
+        while jobs and jobs[0].dropped:
+            heapq.heappop(jobs)
+        if not jobs:
+            self.chats.pop(chat_id, None)
+            return None
+        return jobs[0]
+
+    def schedule_chat(self, chat_id: int):
+        job = self.head(chat_id)
+        if job is not None:
+            heapq.heappush(self.ready, (job.priority, job.sequence, chat_id))
+            self.wakeup.set()
+
+    def chat_delay(self, chat_id: int) -> float:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return max(bucket.delay_for(1), self.paused_until.get(chat_id, 0) - time.monotonic())
+
+    def prune(self):
+        if len(self.chat_buckets) <= OUTBOUND_MAX_IDLE_CHATS:
+            return
+        now = time.monotonic()
+        for chat_id in [chat_id for chat_id, bucket in self.chat_buckets.items() if chat_id not in self.chats and now - bucket.updated > 60]:
+            del self.chat_buckets[chat_id]
+            self.paused_until.pop(chat_id, None)
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            while self.delayed and self.delayed[0][0] <= now:
+                _, chat_id = heapq.heappop(self.delayed)
+                self.schedule_chat(chat_id)
+
+            if not self.ready:
+                self.wakeup.clear()
+                timeout = self.delayed[0][0] - now if self.delayed else None
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, chat_id = heapq.heappop(self.ready)
+            if chat_id in self.busy or self.head(chat_id) is None:
+                continue
+            delay = self.chat_delay(chat_id)
+            if delay > 0:
+                heapq.heappush(self.delayed, (now + delay, chat_id))
+                continue
+
+            global_delay = self.global_bucket.delay_for(1)
+            if global_delay > 0:
+                heapq.heappush(self.ready, (self.chats[chat_id][0].priority, self.chats[chat_id][0].sequence, chat_id))
+                await asyncio.sleep(global_delay)
+                continue
+
+            self.global_bucket.consume(1)
+            self.chat_buckets[chat_id].consume(1)
+            job = heapq.heappop(self.chats[chat_id])
+            self.busy.add(chat_id)
+            asyncio.create_task(self.deliver(job))
+            self.prune()
+
+    async def deliver(self, job: OutboundJob):
+        job.attempts += 1
+        self.forget_key(job)
+        labels = (('priority', OUTBOUND_PRIORITY_NAMES[job.priority]),)
+        started = time.monotonic()
+        metrics.observe('bot_telegram_queue_wait_seconds', labels, started - job.enqueued_at)
         try:
-            await update.message.reply_text(text)
+            result = await job.request()
+        except telegram.error.RetryAfter as e:
+            metrics.increment('bot_telegram_flood_waits_total')
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            logger.warning(f"Flood control for chat {job.chat_id}: retrying in {retry_after}s.")
+            self.paused_until[job.chat_id] = time.monotonic() + retry_after
+            self.requeue(job)
+        except telegram.error.BadRequest as e:
+            self.finish(job, error=e)
+        except (telegram.error.TimedOut, telegram.error.NetworkError) as e:
+            if job.attempts < OUTBOUND_MAX_ATTEMPTS:
+                logger.warning(f"Outbound request for chat {job.chat_id} failed ({e}); retrying.")
+                self.paused_until[job.chat_id] = time.monotonic() + job.attempts
+                self.requeue(job)
+            else:
+                self.finish(job, error=e)
         except Exception as e:
-            logger.error(f"Failed to send message for user {update.message.from_user.id}: {e}")
-        return
+            self.finish(job, error=e)
+        else:
+            self.finish(job, result=result)
+        finally:
+            metrics.observe('bot_telegram_request_seconds', labels, time.monotonic() - started)
+
+    def requeue(self, job: OutboundJob):
+        heapq.heappush(self.chats.setdefault(job.chat_id, []), job)
+        self.busy.discard(job.chat_id)
+        self.schedule_chat(job.chat_id)
 
-    parts = []
-    current_part = ""
-    lines = text.split('\n')
-    for line in lines:
-        if len(current_part) + len(line) + 1 > MAX_MESSAGE_LENGTH:
-            if current_part:
-                parts.append(current_part)
-            current_part = line
-            while len(current_part) > MAX_MESSAGE_LENGTH:
-                parts.append(current_part[:MAX_MESSAGE_LENGTH])
-                current_part = current_part[MAX_MESSAGE_LENGTH:]
+    def finish(self, job: OutboundJob, result=None, error: Exception = None):
+        self.pending -= 1
+        self.busy.discard(job.chat_id)
+        if not job.future.done():
+            if error is not None:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+        self.schedule_chat(job.chat_id)
+
+outbox = OutboundQueue(TELEGRAM_GLOBAL_MESSAGES_PER_SECOND, TELEGRAM_CHAT_MESSAGES_PER_SECOND, TELEGRAM_CHAT_BURST)
+
+async def send_text(message, text: str, priority: int = OUTBOUND_PRIORITY_REPLY, **kwargs):
+    return await outbox.submit(message.chat_id, lambda: message.reply_text(text, **kwargs), priority)
+
+async def send_status(message, text: str):
+    return await send_text(message, text, OUTBOUND_PRIORITY_STATUS)
+
+async def send_action(message, action: str):
+    return await outbox.submit(message.chat_id, lambda: message.chat.send_action(action), OUTBOUND_PRIORITY_STATUS, key=('action', message.chat_id))
+
+class GeminiScheduler:
+    def __init__(self, max_concurrent_requests: int, requests_per_minute: int, tokens_per_minute: int):
+        self.max_concurrent_requests = max_concurrent_requests
+        self.request_bucket = TokenBucket(requests_per_minute / 60, requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+        self.semaphore = None
+        self.quota_lock = None
+
+    async def acquire_quota(self, estimated_tokens: int):
+        if self.quota_lock is None:
+            self.quota_lock = asyncio.Lock()
+        async with self.quota_lock:
+            while True:
+                delay = max(self.request_bucket.delay_for(1), self.token_bucket.delay_for(estimated_tokens))
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            self.request_bucket.consume(1)
+            self.token_bucket.consume(estimated_tokens)
+
+    def record_usage(self, estimated_tokens: int, response):
+        usage = getattr(response, 'usage_metadata', None)
+        actual_tokens = getattr(usage, 'total_token_count', 0)
+        if actual_tokens:
+            self.token_bucket.consume(actual_tokens - estimated_tokens)
+
+    async def run(self, request, estimated_tokens: int, can_retry=None):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        attempt = 0
+        while True:
+            await self.acquire_quota(estimated_tokens)
+            try:
+                async with self.semaphore:
+                    response = await request()
+                self.record_usage(estimated_tokens, response)
+                return response
+            except ResourceExhausted as e:
+                metrics.increment('bot_gemini_quota_errors_total')
+                if attempt >= GEMINI_MAX_RETRIES or (can_retry and not can_retry()):
+                    raise
+                delay = random.uniform(0, min(GEMINI_RETRY_MAX_DELAY, GEMINI_RETRY_BASE_DELAY * 2 ** attempt))
+                attempt += 1
+                logger.warning(f"Gemini quota exhausted ({e}), retry {attempt}/{GEMINI_MAX_RETRIES} in {delay:.1f}s.")
+                await asyncio.sleep(delay)
+
+gemini_scheduler = GeminiScheduler(MAX_CONCURRENT_GEMINI_REQUESTS, GEMINI_REQUESTS_PER_MINUTE, GEMINI_TOKENS_PER_MINUTE)
+
+class CircuitBreaker:
+    def __init__(self, name: str):
+        self.name = name
+        self.outcomes = deque(maxlen=BREAKER_WINDOW)
+        self.open_until = 0
+        self.probing = False
+
+    def is_open(self) -> bool:
+        return self.open_until > 0
+
+    def acquire_probe(self) -> bool:
+        if not self.is_open() or self.probing or time.monotonic() < self.open_until:
+            return False
+        self.probing = True
+        return True
+
+    def record(self, success: bool, elapsed: float, probe: bool):
+        success = success and elapsed < BREAKER_SLOW_SECONDS
+        if probe:
+            self.probing = False
+            if success:
+                self.open_until = 0
+                self.outcomes.clear()
+                logger.info(f"Circuit for model {self.name} closed again.")
+            else:
+                self.open_until = time.monotonic() + BREAKER_COOLDOWN
+            return
+        if self.is_open():
+            return
+        self.outcomes.append(success)
+        failures = self.outcomes.count(False)
+        if len(self.outcomes) >= BREAKER_MIN_CALLS and failures >= BREAKER_FAILURE_RATIO * len(self.outcomes):
+            self.open_until = time.monotonic() + BREAKER_COOLDOWN
+            self.outcomes.clear()
+            metrics.increment('bot_circuit_opened_total', (('model', self.name),))
+            logger.warning(f"Circuit for model {self.name} opened after {failures} failed or slow calls; retrying in {BREAKER_COOLDOWN}s.")
+
+class ModelPool:
+    def __init__(self, router, names: list):
+        self.router = router
+        self.names = names
+        self.model_name = ",".join(names)
+
+    def start_chat(self, history=None):
+        return RoutedChatSession(self, history)
+
+    async def generate_content_async(self, contents, **kwargs):
+        return await self.router.call(self, lambda model: model.generate_content_async(contents, **kwargs))
+
+class RoutedChatSession:
+    def __init__(self, model: ModelPool, history=None):
+        self.model = model
+        self.session = None
+        self._history = list(history or [])
+
+    @property
+    def history(self):
+        return self.session.history if self.session is not None else self._history
+
+    @history.setter
+    def history(self, history):
+        if self.session is not None:
+            self.session.history = history
         else:
-            current_part += ('\n' if current_part else '') + line
-    if current_part:
-        parts.append(current_part)
+            self._history = history
+
+    async def send_message_async(self, content, **kwargs):
+        history = self.history
+
+        async def attempt(model):
+            session = model.start_chat(history=history)
+            response = await session.send_message_async(content, **kwargs)
+            return session, response
+
+        self.session, response = await self.model.router.call(self.model, attempt)
+        return response
+
+class ModelRouter:
+    def __init__(self):
+        self.models = {}
+        self.breakers = {}
+        self.latencies = {}
+        self.requests = 0
+        self.hedges = 0
+
+    def pool(self, spec: str) -> ModelPool:
+        names = [name.strip() for name in spec.split(',') if name.strip()]
+        for name in names:
+            if name not in self.models:
+                self.models[name] = genai.GenerativeModel(name)
+            self.breakers.setdefault(name, CircuitBreaker(name))
+            self.latencies.setdefault(name, deque(maxlen=MODEL_LATENCY_SAMPLES))
+        return ModelPool(self, names)
+
+    def hedge_delay(self, name: str):
+        if HEDGE_PERCENTILE <= 0 or self.hedges >= HEDGE_BUDGET * self.requests + 1:
+            return None
+        samples = sorted(self.latencies[name])
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, samples[min(len(samples) - 1, int(HEDGE_PERCENTILE * len(samples)))])
+
+    def should_fail_over(self, error: Exception) -> bool:
+        return not isinstance(error, (BlockedPromptException, StopCandidateException, InvalidArgument))
+
+    async def attempt(self, name: str, request, probe: bool):
+        breaker = self.breakers[name]
+        started = time.monotonic()
+        try:
+            result = await request(self.models[name])
+        except asyncio.CancelledError:
+            if probe:
+                breaker.probing = False
+            raise
+        except Exception as e:
+            breaker.record(not self.should_fail_over(e), time.monotonic() - started, probe)
+            raise
+        elapsed = time.monotonic() - started
+        breaker.record(True, elapsed, probe)
+        self.latencies[name].append(elapsed)
+        metrics.observe('bot_model_seconds', (('model', name),), elapsed)
+        return result
+
+    async def call(self, pool: ModelPool, request):
+        self.requests += 1
+        remaining = list(pool.names)
+        launched = []
+        pending = {}
+        error = None
+
+        def start(name: str, probe: bool):
+            launched.append(name)
+            pending[asyncio.create_task(self.attempt(name, request, probe))] = name
+
+        def launch():
+            while remaining:
+                name = remaining.pop(0)
+                probe = self.breakers[name].is_open()
+                if not probe or self.breakers[name].acquire_probe():
+                    start(name, probe)
+                    return name
+            return None
+
+        if launch() is None:
+            start(pool.names[0], False)
+        try:
+            while pending:
+                timeout = None
+                if len(pending) == 1 and remaining:
+                    timeout = self.hedge_delay(launched[-1])
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    name = launch()
+                    if name is not None:
+                        self.hedges += 1
+                        metrics.increment('bot_hedged_requests_total', (('model', name),))
+                        logger.info(f"Model {launched[-2]} is slow, hedging with {name}.")
+                    continue
+                for task in done:
+                    name = pending.pop(task)
+                    if task.exception() is None:
+                        if name != pool.names[0]:
+                            metrics.increment('bot_model_fallbacks_total', (('model', name),))
+                        return task.result()
+                    error = task.exception()
+                    if not self.should_fail_over(error):
+                        raise error
+                    logger.warning(f"Model {name} failed: {error}")
+                if not pending:
+                    launch()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+model_router = ModelRouter()
+
+def get_update_user_id(update: object):
+    if isinstance(update, Update) and update.effective_user:
+        return update.effective_user.id
+    return None
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self.user_queues = {}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        with lifecycle.track():
+            await self.process_in_order(update, coroutine)
+
+    async def process_in_order(self, update: object, coroutine) -> None:
+        user_id = get_update_user_id(update)
+        if user_id is None:
+            await coroutine
+            return
+        await self.run_for_user(user_id, coroutine)
+
+    async def run_for_user(self, user_id: int, coroutine, droppable: bool = True) -> None:
+        entry = self.user_queues.get(user_id)
+        if entry is None:
+            entry = self.user_queues[user_id] = [asyncio.Lock(), 0]
+        if droppable and entry[1] >= MAX_PENDING_UPDATES_PER_USER:
+            coroutine.close()
+            logger.warning(f"Dropped update from user {user_id}: {entry[1]} updates already pending.")
+            return
+
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.user_queues[user_id]
+
+class LifecycleManager:
+    def __init__(self):
+        self.in_flight = 0
+        self.background_tasks = set()
+        self.shutting_down = False
+        self.restart_requested = False
+        self.finished = None
+
+    @contextmanager
+    def track(self):
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    def track_task(self, task: asyncio.Task):
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def drain(self, application: Application, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while self.in_flight or self.background_tasks or application.update_queue.qsize() or outbox.pending:
+            if time.monotonic() >= deadline:
+                logger.warning(f"Drain deadline reached with {self.in_flight} updates, {application.update_queue.qsize()} queued updates and {len(self.background_tasks)} background tasks still pending.")
+                return False
+            await asyncio.sleep(0.1)
+        return True
+
+    async def shutdown(self, application: Application, restart: bool = False):
+        if self.shutting_down:
+            return
+        self.shutting_down = True
+        self.restart_requested = restart
+        logger.info(f"Graceful {'restart' if restart else 'shutdown'} started: no longer accepting updates.")
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        if await self.drain(application, SHUTDOWN_DRAIN_TIMEOUT):
+            logger.info("All in-flight updates finished.")
+        await history_store.flush(compact=True)
+        await gemini_file_janitor.flush()
+        if self.finished is not None:
+            self.finished.set()
+        else:
+            application.stop_running()
+
+    def request_shutdown(self, application: Application, restart: bool = False):
+        asyncio.get_running_loop().create_task(self.shutdown(application, restart))
+
+lifecycle = LifecycleManager()
+
+def build_models():
+    global text_model, short_text_model, vision_audio_model
+    model_router.models.clear()
+    text_model = model_router.pool(TEXT_MODEL_NAME)
+    short_text_model = model_router.pool(SHORT_TEXT_MODEL_NAME) if SHORT_TEXT_MODEL_NAME else text_model
+    vision_audio_model = model_router.pool(VISION_AUDIO_MODEL_NAME)
+
+build_models()
+
+def select_text_model(text: str) -> ModelPool:
+    return short_text_model if len(text) <= SHORT_TEXT_MAX_CHARS else text_model
 
-    for part in parts:
-        if part.strip():
+def reload_configuration():
+    global GEMINI_API_KEY, TEXT_MODEL_NAME, SHORT_TEXT_MODEL_NAME, VISION_AUDIO_MODEL_NAME
+    load_dotenv(override=True)
+    GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") or GEMINI_API_KEY
+    TEXT_MODEL_NAME = os.getenv("TEXT_MODEL", "gemini-2.5-flash")
+    SHORT_TEXT_MODEL_NAME = os.getenv("SHORT_TEXT_MODEL", "")
+    VISION_AUDIO_MODEL_NAME = os.getenv("VISION_AUDIO_MODEL", "gemini-2.5-flash")
+    genai.configure(api_key=GEMINI_API_KEY)
+    build_models()
+
+    requests_per_minute = int(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "1000"))
+    tokens_per_minute = int(os.getenv("GEMINI_TOKENS_PER_MINUTE", "1000000"))
+    gemini_scheduler.request_bucket = TokenBucket(requests_per_minute / 60, requests_per_minute)
+    gemini_scheduler.token_bucket = TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+
+    RATE_LIMIT_WHITELIST.clear()
+    RATE_LIMIT_WHITELIST.update(int(user_id) for user_id in os.getenv("RATE_LIMIT_WHITELIST", "").split(",") if user_id.strip())
+    FULL_HISTORY_ENABLED_USERS.clear()
+    FULL_HISTORY_ENABLED_USERS.update(load_full_history_users())
+
+    session_manager.clear()
+    logger.info(f"Configuration reloaded (text model {TEXT_MODEL_NAME}, vision/audio model {VISION_AUDIO_MODEL_NAME}).")
+
+async def report_processing_error(update: Update, error: Exception, kind: str, subject: str):
+    user_id = update.message.from_user.id
+    session_manager.drop(user_id)
+    handler_labels = (('handler', current_handler.get()),)
+    if isinstance(error, BlockedPromptException):
+        metrics.increment('bot_blocked_prompts_total', handler_labels)
+        logger.warning(f"Blocked content detected for user {user_id}: {error}")
+        await send_text(update.message, "Sorry, your request contains content that was blocked due to safety settings.")
+    elif isinstance(error, ResourceExhausted):
+        metrics.increment('bot_errors_total', handler_labels + (('error', 'quota'),))
+        logger.warning(f"Gemini quota exhausted while processing {kind} from {user_id}: {error}")
+        await send_text(update.message, "The service is busy right now. Please try again in a minute.")
+    else:
+        metrics.increment('bot_errors_total', handler_labels + (('error', type(error).__name__),))
+        logger.error(f"Error processing {kind} from {user_id}: {error}", exc_info=error)
+        await send_text(update.message, f"An error occurred while processing your {subject}: {error}")
+
+class StreamingReply:
+    def __init__(self, update: Update):
+        self.update = update
+        self.text = ""
+        self.messages = []
+        self.sent_parts = []
+        self.last_render = 0
+
+    async def start(self):
+        self.messages.append(await send_text(self.update.message, STREAM_PLACEHOLDER_TEXT))
+        self.sent_parts.append(STREAM_PLACEHOLDER_TEXT)
+        self.last_render = time.monotonic()
+
+    async def push(self, text: str):
+        self.text += text
+        if time.monotonic() - self.last_render >= STREAM_EDIT_INTERVAL:
+            await self.render()
+
+    async def render(self) -> list:
+        parts = render_chunks(self.text, MAX_MESSAGE_LENGTH)
+        for index, part in enumerate(parts):
+            if index >= len(self.messages):
+                self.messages.append(await reply_html(self.update.message, part))
+                self.sent_parts.append(part)
+            elif self.sent_parts[index] != part:
+                try:
+                    await edit_html(self.messages[index], part)
+                    self.sent_parts[index] = part
+                except telegram.error.BadRequest as e:
+                    logger.debug(f"Skipped streaming edit for user {self.update.message.from_user.id}: {e}")
+        self.last_render = time.monotonic()
+        return parts
+
+    async def finish(self):
+        parts = await self.render()
+        for message in self.messages[len(parts):]:
+            await self.delete(message)
+        del self.messages[len(parts):]
+        del self.sent_parts[len(parts):]
+
+    async def abort(self):
+        if self.sent_parts == [STREAM_PLACEHOLDER_TEXT]:
+            await self.delete(self.messages[0])
+
+    async def delete(self, message):
+        try:
+            await outbox.submit(message.chat_id, message.delete, OUTBOUND_PRIORITY_EDIT)
+        except telegram.error.TelegramError as e:
+            logger.debug(f"Could not delete streaming message for user {self.update.message.from_user.id}: {e}")
+
+async def stream_reply(update: Update, chat_session, content, estimated_tokens: int) -> str:
+    reply = StreamingReply(update)
+    placeholder = asyncio.create_task(reply.start())
+
+    async def request():
+        started = time.perf_counter()
+        response = await chat_session.send_message_async(content, safety_settings=safety_settings, stream=True)
+        await placeholder
+        async for chunk in response:
+            if not chunk.candidates or not chunk.candidates[0].content.parts:
+                continue
+            if not reply.text:
+                labels = (('handler', current_handler.get()), ('stage', 'first_token'), ('model', model_label(getattr(chat_session, 'model', None))))
+                metrics.observe('bot_stage_seconds', labels, time.perf_counter() - started)
+            await reply.push(chunk.text)
+        if not reply.text:
+            await reply.push(response.text)
+        return response
+
+    try:
+        await gemini_scheduler.run(request, estimated_tokens, can_retry=lambda: not reply.text)
+        await reply.finish()
+        return reply.text
+    except Exception:
+        await asyncio.wait([placeholder])
+        await reply.abort()
+        raise
+
+async def generate_reply(update: Update, chat_session, content) -> str:
+    estimated_tokens = estimate_tokens(chat_session.history) + estimate_tokens([content])
+    model = model_label(getattr(chat_session, 'model', None))
+    if STREAM_RESPONSES:
+        with metrics.timer('generate', model):
+            return await stream_reply(update, chat_session, content, estimated_tokens)
+    with metrics.timer('generate', model):
+        response = await gemini_scheduler.run(
+            lambda: chat_session.send_message_async(content, safety_settings=safety_settings),
+            estimated_tokens,
+        )
+    with metrics.timer('send'):
+        await send_long_message(update, response.text)
+    return response.text
+
+def select_photo_size(photos):
+    for photo in sorted(photos, key=lambda p: p.width * p.height):
+        if max(photo.width, photo.height) >= PHOTO_TARGET_RESOLUTION:
+            return photo
+    return max(photos, key=lambda p: p.width * p.height)
+
+def is_jpeg(data: bytes) -> bool:
+    return data[:3] == b'\xff\xd8\xff'
+
+def preprocess_image(data: bytes, max_resolution: int, quality: int) -> bytes:
+    with Image.open(BytesIO(data)) as image:
+        image.draft('RGB', (max_resolution, max_resolution))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.thumbnail((max_resolution, max_resolution))
+        output = BytesIO()
+        image.save(output, format='JPEG', quality=quality)
+        return output.getvalue()
+
+image_process_pool = None
+
+def get_image_process_pool() -> ProcessPoolExecutor:
+    global image_process_pool
+    if image_process_pool is None:
+        image_process_pool = ProcessPoolExecutor(max_workers=IMAGE_PROCESS_WORKERS)
+    return image_process_pool
+
+def shutdown_image_process_pool():
+    global image_process_pool
+    if image_process_pool is not None:
+        image_process_pool.shutdown(wait=False, cancel_futures=True)
+        image_process_pool = None
+
+async def prepare_photo(data: bytes, photo) -> bytes:
+    if is_jpeg(data) and max(photo.width, photo.height) <= PHOTO_MAX_RESOLUTION:
+        return data
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_image_process_pool(), preprocess_image, data, PHOTO_MAX_RESOLUTION, PHOTO_JPEG_QUALITY)
+
+def release_abandoned_upload(upload: asyncio.Future):
+    if not upload.cancelled() and upload.exception() is None:
+        gemini_file_janitor.release(upload.result())
+
+async def build_media_part(data: bytes, mime_type: str, display_name: str):
+    if len(data) <= INLINE_MEDIA_MAX_BYTES:
+        return {"mime_type": mime_type, "data": data}
+    upload = asyncio.ensure_future(asyncio.to_thread(genai.upload_file, path=BytesIO(data), display_name=display_name, mime_type=mime_type))
+    try:
+        with metrics.timer('upload'):
+            uploaded_file = await asyncio.shield(upload)
+    except asyncio.CancelledError:
+        upload.add_done_callback(release_abandoned_upload)
+        raise
+    logger.info(f"Uploaded {len(data)} bytes to Gemini as {uploaded_file.name}")
+    return uploaded_file
+
+class GeminiFileJanitor:
+    def __init__(self):
+        self.pending = []
+        self.task = None
+
+    def release(self, media_part):
+        if media_part is not None and not isinstance(media_part, dict):
+            self.pending.append(media_part.name)
+
+    async def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
             try:
-                await update.message.reply_text(part)
-                await asyncio.sleep(0.5)
-            except Exception as e:
-                logger.error(f"Failed to send message part for user {update.message.from_user.id}: {e}")
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(GEMINI_FILE_JANITOR_INTERVAL)
+            await self.flush()
+
+    async def flush(self):
+        while self.pending:
+            batch = self.pending[:GEMINI_FILE_JANITOR_BATCH_SIZE]
+            del self.pending[:GEMINI_FILE_JANITOR_BATCH_SIZE]
+            results = await asyncio.gather(*(asyncio.to_thread(genai.delete_file, name) for name in batch), return_exceptions=True)
+            for name, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Error deleting Gemini file {name}: {result}")
+                else:
+                    logger.info(f"Deleted Gemini file {name}")
+
+gemini_file_janitor = GeminiFileJanitor()
+
+class LRUCache:
+    def __init__(self, name: str, max_entries: int, max_bytes: int, ttl: float, on_evict=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, size, expires_at = entry
+        if expires_at <= time.monotonic():
+            self.remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, size: int) -> bool:
+        if size > self.max_bytes:
+            return False
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = (value, size, time.monotonic() + self.ttl)
+        self.total_bytes += size
+        while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+        return key in self.entries
+
+    def remove(self, key):
+        value, size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+        if self.on_evict:
+            self.on_evict(value)
+
+    def clear(self) -> int:
+        count = len(self.entries)
+        for key in list(self.entries):
+            self.remove(key)
+        return count
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups else 0
+        return (
+            f"{self.name}: {len(self.entries)} entries, {self.total_bytes // 1024} KB, "
+            f"{self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), {self.evictions} evictions"
+        )
+
+media_cache = LRUCache("Media cache", MEDIA_CACHE_MAX_ENTRIES, MEDIA_CACHE_MAX_BYTES, MEDIA_CACHE_TTL, on_evict=gemini_file_janitor.release)
+response_cache = LRUCache("Response cache", RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL)
+
+def make_response_cache_key(model, history: list, prompt: list) -> str:
+    payload = json.dumps([model.model_name, history, prompt], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class FileDownloader:
+    def __init__(self, pool_size: int, timeout: float, transport=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.transport = transport
+        self.client = None
+
+    async def fetch(self, url: str) -> bytes:
+        if self.client is None:
+            limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+            self.client = httpx.AsyncClient(limits=limits, timeout=self.timeout, transport=self.transport)
+        response = await self.client.get(url)
+        response.raise_for_status()
+        return response.content
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+file_downloader = FileDownloader(DOWNLOAD_POOL_SIZE, DOWNLOAD_TIMEOUT)
+
+async def load_media_part(context: ContextTypes.DEFAULT_TYPE, file_unique_id: str, file_id: str, mime_type: str, display_name: str, transform=None) -> tuple:
+    media_part = media_cache.get(file_unique_id)
+    if media_part is not None:
+        logger.info(f"Reusing cached media {file_unique_id}.")
+        return media_part, True
+
+    with metrics.timer('download'):
+        file = await context.bot.get_file(file_id)
+        data = await file_downloader.fetch(file.file_path)
+    if transform:
+        with metrics.timer('preprocess'):
+            data = await transform(data)
+
+    media_part = await build_media_part(data, mime_type, display_name)
+    size = len(data) if isinstance(media_part, dict) else UPLOADED_MEDIA_CACHE_SIZE
+    return media_part, media_cache.put(file_unique_id, media_part, size)
+
+def new_rate_limit_state(now: float, max_messages: float) -> dict:
+    return {
+        'tokens': max_messages,
+        'updated': now,
+        'last_message': '',
+        'last_message_count': 0,
+        'blocked_until': 0,
+        'last_seen': now,
+    }
+
+def apply_rate_limit(state: dict, now: float, message_content: str, limit) -> tuple:
+    state['last_seen'] = now
+    if state['blocked_until'] > now:
+        return 'blocked', int(state['blocked_until'] - now)
+
+    if limit:
+        max_messages, window = limit
+        state['tokens'] = min(max_messages, state['tokens'] + (now - state['updated']) * max_messages / window)
+        state['updated'] = now
+        state['tokens'] -= 1
+
+    if (message_content and message_content.lower() == state['last_message'].lower()):
+        state['last_message_count'] += 1
+    else:
+        state['last_message'] = message_content
+        state['last_message_count'] = 1
+
+    if state['last_message_count'] > REPEAT_MESSAGE_THRESHOLD:
+        return 'repeat', 0
+
+    if limit and state['tokens'] < 0:
+        state['blocked_until'] = now + COOLDOWN_SECONDS
+        return 'limited', COOLDOWN_SECONDS
+
+    return 'ok', 0
+
+class RateLimitBackend:
+    blocking = False
+
+    def update(self, user_id: int, now: float, message_content: str, limit) -> tuple:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    def __init__(self, idle_seconds: float):
+        self.idle_seconds = idle_seconds
+        self.states = OrderedDict()
+
+    def update(self, user_id: int, now: float, message_content: str, limit) -> tuple:
+        state = self.states.pop(user_id, None) or new_rate_limit_state(now, limit[0] if limit else 0)
+        result = apply_rate_limit(state, now, message_content, limit)
+        self.states[user_id] = state
+        while self.states:
+            oldest = next(iter(self.states.values()))
+            if now - oldest['last_seen'] < self.idle_seconds or oldest['blocked_until'] > now:
+                break
+            self.states.popitem(last=False)
+        return result
+
+class SqliteRateLimitBackend(RateLimitBackend):
+    blocking = True
+
+    def __init__(self, db_path: str, idle_seconds: float):
+        self.idle_seconds = idle_seconds
+        self.last_eviction = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, timeout=5, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS rate_limits (user_id INTEGER PRIMARY KEY, state TEXT NOT NULL, last_seen REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS idx_rate_limits_last_seen ON rate_limits (last_seen)")
+
+    def update(self, user_id: int, now: float, message_content: str, limit) -> tuple:
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute("SELECT state FROM rate_limits WHERE user_id = ?", (user_id,)).fetchone()
+                state = json.loads(row[0]) if row else new_rate_limit_state(now, limit[0] if limit else 0)
+                result = apply_rate_limit(state, now, message_content, limit)
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO rate_limits (user_id, state, last_seen) VALUES (?, ?, ?)",
+                    (user_id, json.dumps(state, ensure_ascii=False), max(now, state['blocked_until'])),
+                )
+                if now - self.last_eviction >= RATE_LIMIT_EVICTION_INTERVAL:
+                    self.connection.execute("DELETE FROM rate_limits WHERE last_seen < ?", (now - self.idle_seconds,))
+                    self.last_eviction = now
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return result
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class RateLimiter:
+    def __init__(self, backend: RateLimitBackend):
+        self.backend = backend
+
+    def get_tier(self, user_id: int) -> str:
+        if user_id == ADMIN_USER_ID:
+            return 'admin'
+        if user_id in RATE_LIMIT_WHITELIST:
+            return 'whitelist'
+        return 'default'
+
+    async def check(self, user_id: int, message_content: str) -> tuple:
+        limit = RATE_LIMIT_TIERS[self.get_tier(user_id)]
+        now = time.time()
+        if self.backend.blocking:
+            return await asyncio.to_thread(self.backend.update, user_id, now, message_content, limit)
+        return self.backend.update(user_id, now, message_content, limit)
+
+def create_rate_limit_backend() -> RateLimitBackend:
+    if RATE_LIMIT_BACKEND == 'sqlite':
+        return SqliteRateLimitBackend(RATE_LIMIT_DB_FILE, RATE_LIMIT_IDLE_SECONDS)
+    if RATE_LIMIT_BACKEND != 'memory':
+        raise ValueError(f"Unknown RATE_LIMIT_BACKEND '{RATE_LIMIT_BACKEND}'. Use 'memory' or 'sqlite'.")
+    return MemoryRateLimitBackend(RATE_LIMIT_IDLE_SECONDS)
+
+rate_limiter = RateLimiter(create_rate_limit_backend())
 
 async def check_spam(update: Update, message_content: str) -> bool:
     user_id = update.message.from_user.id
-    current_time = time.time()
-    
-    if user_id not in user_activity:
-        user_activity[user_id] = {
-            'timestamps': [],
-            'last_message': '',
-            'last_message_count': 0,
-            'blocked_until': 0
-        }
-    
-    activity = user_activity[user_id]
-    
-    if activity['blocked_until'] > current_time:
-        remaining_time = int(activity['blocked_until'] - current_time)
-        await update.message.reply_text(f"Please wait {remaining_time} seconds before sending a new request.")
+    verdict, wait_seconds = await rate_limiter.check(user_id, message_content)
+    if verdict != 'ok':
+        metrics.increment('bot_rate_limit_hits_total', (('verdict', verdict),))
+
+    if verdict == 'blocked':
+        await send_text(update.message, f"Please wait {wait_seconds} seconds before sending a new request.")
         return True
-    
-    activity['timestamps'] = [t for t in activity['timestamps'] if current_time - t < RATE_LIMIT_SECONDS]
-    activity['timestamps'].append(current_time)
-    
-    if (message_content and message_content.lower() == activity['last_message'].lower()):
-        activity['last_message_count'] += 1
-    else:
-        activity['last_message'] = message_content
-        activity['last_message_count'] = 1
-        
-    if activity['last_message_count'] > REPEAT_MESSAGE_THRESHOLD:
-        await update.message.reply_text("I have already received this message. Please send something new.")
+
+    if verdict == 'repeat':
+        await send_text(update.message, "I have already received this message. Please send something new.")
         return True
-    
-    if len(activity['timestamps']) > RATE_LIMIT_MESSAGES:
-        activity['blocked_until'] = current_time + COOLDOWN_SECONDS
-        await update.message.reply_text(f"You are sending too many messages. Please wait {COOLDOWN_SECONDS} seconds.")
-        logger.warning(f"User {user_id} hit rate limit, blocked for {COOLDOWN_SECONDS} seconds.")
+
+    if verdict == 'limited':
+        await send_text(update.message, f"You are sending too many messages. Please wait {wait_seconds} seconds.")
+        logger.warning(f"User {user_id} hit rate limit, blocked for {wait_seconds} seconds.")
         return True
-    
+
     return False
 
+class MessageBurst:
+    def __init__(self, context: ContextTypes.DEFAULT_TYPE, window: float):
+        self.context = context
+        self.window = window
+        self.items = []
+        self.media_groups = set()
+        self.opened_at = time.monotonic()
+        self.last_at = self.opened_at
+        self.closed = asyncio.Event()
+        self.flushed = False
+        self.typing = None
+
+    def add(self, update: Update, process):
+        self.items.append((update, process))
+        self.last_at = time.monotonic()
+        if update.message.media_group_id:
+            self.media_groups.add(update.message.media_group_id)
+            self.window = max(self.window, MEDIA_GROUP_WINDOW)
+
+class BurstBuffer:
+    def __init__(self, window: float, max_wait: float, max_messages: int):
+        self.window = window
+        self.max_wait = max_wait
+        self.max_messages = max_messages
+        self.bursts = {}
+        self.rejected_media_groups = {}
+
+    async def submit(self, update: Update, context: ContextTypes.DEFAULT_TYPE, spam_check_content: str, process):
+        user_id = update.message.from_user.id
+        media_group_id = update.message.media_group_id
+        burst = self.bursts.get(user_id)
+        if burst is not None and (self.window > 0 or media_group_id in burst.media_groups):
+            burst.add(update, process)
+            if not media_group_id and len(burst.items) >= self.max_messages:
+                self.close(user_id, burst)
+            return
+
+        if burst is None and self.window <= 0 and not media_group_id:
+            if not await check_spam(update, spam_check_content):
+                await process(update, context)
+            return
+
+        rejected = self.rejected_media_groups.get(user_id)
+        if media_group_id and rejected and rejected[0] == media_group_id and time.monotonic() - rejected[1] < MEDIA_GROUP_WINDOW:
+            rejected[1] = time.monotonic()
+            return
+        if burst is not None:
+            self.close(user_id, burst)
+        if await check_spam(update, spam_check_content):
+            if media_group_id:
+                self.forget_rejected_media_groups()
+                self.rejected_media_groups[user_id] = [media_group_id, time.monotonic()]
+            return
+        self.rejected_media_groups.pop(user_id, None)
+        burst = self.bursts[user_id] = MessageBurst(context, self.window)
+        burst.add(update, process)
+        burst.typing = asyncio.create_task(self.keep_typing(update.message))
+        lifecycle.track_task(asyncio.create_task(self.flush_when_quiet(user_id, burst)))
+
+    def forget_rejected_media_groups(self):
+        now = time.monotonic()
+        for user_id, (_, rejected_at) in list(self.rejected_media_groups.items()):
+            if now - rejected_at >= MEDIA_GROUP_WINDOW:
+                del self.rejected_media_groups[user_id]
+
+    async def keep_typing(self, message):
+        while True:
+            try:
+                await send_action(message, ChatAction.TYPING)
+            except telegram.error.TelegramError as e:
+                logger.debug(f"Typing indicator for chat {message.chat_id} failed: {e}")
+            await asyncio.sleep(BURST_TYPING_INTERVAL)
+
+    def close(self, user_id: int, burst: MessageBurst):
+        if self.bursts.get(user_id) is burst:
+            del self.bursts[user_id]
+        burst.closed.set()
+
+    async def flush(self, user_id: int):
+        burst = self.bursts.get(user_id)
+        if burst is None:
+            return
+        burst.flushed = True
+        self.close(user_id, burst)
+        await self.process(burst)
+
+    async def flush_when_quiet(self, user_id: int, burst: MessageBurst):
+        try:
+            while not burst.closed.is_set():
+                delay = min(burst.last_at + burst.window, burst.opened_at + self.max_wait) - time.monotonic()
+                if delay <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(burst.closed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if self.bursts.get(user_id) is burst:
+                del self.bursts[user_id]
+            burst.typing.cancel()
+        if not burst.flushed:
+            await burst.context.application.update_processor.run_for_user(user_id, self.process(burst), droppable=False)
+
+    async def process(self, burst: MessageBurst):
+        if len(burst.items) == 1:
+            update, process = burst.items[0]
+            await process(update, burst.context)
+        else:
+            await process_burst([update for update, _ in burst.items], burst.context)
+
+message_bursts = BurstBuffer(BURST_WINDOW, BURST_MAX_WAIT, BURST_MAX_MESSAGES)
+
+async def flush_message_burst(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await message_bursts.flush(update.message.from_user.id)
+
+async def reject_non_admin(update: Update, command: str) -> bool:
+    if update.message.from_user.id == ADMIN_USER_ID:
+        return False
+    await send_text(update.message, "You are not authorized to use this command.")
+    logger.warning(f"Unauthorized access to /{command} command by user {update.message.from_user.id}")
+    return True
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info(f"User {update.message.from_user.id} started the bot.")
-    await update.message.reply_text('Hi! I am a Gemini-based bot. Send me a message, photo, or voice message.')
+    await send_text(update.message, 'Hi! I am a Gemini-based bot. Send me a message, photo, or voice message.')
 
 async def clear_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.message.from_user.id
-    if user_id in user_chat_sessions:
-        del user_chat_sessions[user_id]
-    if user_id in user_last_active:
-        del user_last_active[user_id]
-
-    std_file_path = get_history_file_path(user_id)
-    if os.path.exists(std_file_path):
-        os.remove(std_file_path)
-        logger.info(f"Deleted standard chat history file for user {user_id}.")
-    
-    full_file_path = get_full_history_file_path(user_id)
-    if os.path.exists(full_file_path):
-        os.remove(full_file_path)
-        logger.info(f"Deleted full chat history file for user {user_id}.")
+    session_manager.drop(user_id)
+
+    await history_store.clear(user_id)
     
     logger.info(f"All chat history cleared for user {user_id}.")
-    await update.message.reply_text("All chat history cleared for you. We can start a new conversation now.")
+    await send_text(update.message, "All chat history cleared for you. We can start a new conversation now.")
 
 async def history_control(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    global FULL_HISTORY_ENABLED_USERS
-    
-    if update.message.from_user.id != ADMIN_USER_ID:
-        await update.message.reply_text("You are not authorized to use this command.")
-        logger.warning(f"Unauthorized access to /history command by user {update.message.from_user.id}")
+    if await reject_non_admin(update, "history"):
         return
 
     args = context.args
     if len(args) != 2 or args[0].lower() not in ["on", "off"]:
-        await update.message.reply_text("Usage: /history <on|off> <user_id>")
+        await send_text(update.message, "Usage: /history <on|off> <user_id>")
         return
 
     action = args[0].lower()
     try:
         target_user_id = int(args[1])
     except ValueError:
-        await update.message.reply_text("Invalid user ID. Please provide a numeric ID.")
+        await send_text(update.message, "Invalid user ID. Please provide a numeric ID.")
         return
 
+    session_manager.drop(target_user_id)
     if action == "on":
         FULL_HISTORY_ENABLED_USERS.add(target_user_id)
-        save_full_history_users(FULL_HISTORY_ENABLED_USERS)
-        await update.message.reply_text(f"Full history logging ENABLED for user {target_user_id}.")
+        await asyncio.to_thread(set_full_history_user, target_user_id, True)
+        await send_text(update.message, f"Full history logging ENABLED for user {target_user_id}.")
         logger.info(f"Admin {ADMIN_USER_ID} enabled full history for user {target_user_id}")
     elif action == "off":
         if target_user_id in FULL_HISTORY_ENABLED_USERS:
             FULL_HISTORY_ENABLED_USERS.remove(target_user_id)
-            save_full_history_users(FULL_HISTORY_ENABLED_USERS)
-            await update.message.reply_text(f"Full history logging DISABLED for user {target_user_id}.")
+            await asyncio.to_thread(set_full_history_user, target_user_id, False)
+            await send_text(update.message, f"Full history logging DISABLED for user {target_user_id}.")
             logger.info(f"Admin {ADMIN_USER_ID} disabled full history for user {target_user_id}")
         else:
-            await update.message.reply_text(f"Full history logging was not enabled for user {target_user_id}.")
+            await send_text(update.message, f"Full history logging was not enabled for user {target_user_id}.")
+
+async def cache_control(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if await reject_non_admin(update, "cache"):
+        return
+
+    args = [arg.lower() for arg in context.args]
+    if not args or args == ["stats"]:
+        await send_text(update.message, f"{media_cache.stats()}\n{response_cache.stats()}")
+        return
+
+    if args[0] != "clear" or len(args) > 2 or (len(args) == 2 and args[1] not in ["media", "responses"]):
+        await send_text(update.message, "Usage: /cache [stats|clear [media|responses]]")
+        return
+
+    cleared = 0
+    if len(args) == 1 or args[1] == "media":
+        cleared += media_cache.clear()
+    if len(args) == 1 or args[1] == "responses":
+        cleared += response_cache.clear()
+    await send_text(update.message, f"Cache invalidated, {cleared} entries removed.")
+    logger.info(f"Admin {ADMIN_USER_ID} invalidated caches ({' '.join(args)}), {cleared} entries removed.")
+
+async def reload_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if await reject_non_admin(update, "reload"):
+        return
+    if WORKER_INDEX is not None:
+        os.kill(os.getppid(), signal.SIGHUP)
+        await send_text(update.message, "Reload sent to all workers.")
+        return
+    try:
+        reload_configuration()
+    except Exception as e:
+        logger.error(f"Configuration reload failed: {e}", exc_info=True)
+        await send_text(update.message, f"Reload failed: {e}")
+        return
+    await send_text(update.message, f"Configuration reloaded. Text model: {TEXT_MODEL_NAME}, short text model: {SHORT_TEXT_MODEL_NAME or TEXT_MODEL_NAME}, vision/audio model: {VISION_AUDIO_MODEL_NAME}.")
+
+async def restart_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if await reject_non_admin(update, "restart"):
+        return
+    await send_text(update.message, "Restarting after in-flight requests finish...")
+    if WORKER_INDEX is not None:
+        os.kill(os.getppid(), signal.SIGUSR2)
+    else:
+        lifecycle.request_shutdown(context.application, restart=True)
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if await reject_non_admin(update, "stats"):
+        return
+    summary = metrics.summary()
+    if WORKER_INDEX is not None:
+        summary = f"Worker {WORKER_INDEX} (other workers report separately):\n{summary}"
+    await send_long_message(update, f"```\n{summary}\n```")
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info(f"User {update.message.from_user.id} sent text message: {update.message.text}")
+    await message_bursts.submit(update, context, update.message.text, process_text)
+
+async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    caption_prompt = update.message.caption or ""
+    logger.info(f"User {update.message.from_user.id} sent photo with caption: {caption_prompt}")
+    spam_check_content = caption_prompt if caption_prompt else f"photo__{update.message.photo[-1].file_id}"
+    await message_bursts.submit(update, context, spam_check_content, process_photo)
+
+async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info(f"User {update.message.from_user.id} sent voice message.")
+    await message_bursts.submit(update, context, f"voice__{update.message.voice.file_id}", process_voice)
+
+async def load_message_media(context: ContextTypes.DEFAULT_TYPE, message) -> tuple:
+    if message.photo:
+        photo = select_photo_size(message.photo)
+        return await load_media_part(
+            context, photo.file_unique_id, photo.file_id, "image/jpeg", f"{photo.file_id}.jpg",
+            transform=lambda data: prepare_photo(data, photo),
+        )
+    voice = message.voice
+    return await load_media_part(context, voice.file_unique_id, voice.file_id, "audio/ogg", f"{voice.file_id}.ogg")
+
+@instrumented('text')
+async def process_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.message.from_user.id
     user_message = update.message.text
-    logger.info(f"User {user_id} sent text message: {user_message}")
-    
-    if await check_spam(update, user_message):
-        return
-        
-    await cleanup_old_sessions()
+    await send_action(update.message, ChatAction.TYPING)
     
-    await update.message.chat.send_action(ChatAction.TYPING)
-    
-    current_history = []
-    if user_id in FULL_HISTORY_ENABLED_USERS:
-        current_history = load_full_chat_history(user_id)
-        logger.info(f"Loaded FULL chat history for user {user_id} ({len(current_history)} messages).")
-    else:
-        current_history = load_chat_history(user_id)
-        logger.info(f"Loaded standard chat history for user {user_id} ({len(current_history)} messages).")
+    with metrics.timer('history_load'):
+        current_history = await history_store.load_context(user_id)
+    history_kind = "FULL" if user_id in FULL_HISTORY_ENABLED_USERS else "standard"
+    logger.info(f"Loaded {history_kind} chat history for user {user_id} ({len(current_history)} messages).")
 
     gemini_history = INITIAL_HTML_INSTRUCTION + current_history
+    model = select_text_model(user_message)
+    cache_key = make_response_cache_key(model, gemini_history, [user_message])
 
+    chat_session = None
     try:
-        chat_session = text_model.start_chat(history=gemini_history)
-
-        response = await chat_session.send_message_async(user_message, safety_settings=safety_settings)
-        final_text = clean_text_for_telegram(response.text)
-        
-        current_history.append({"role": "user", "parts": [user_message]})
-        current_history.append({"role": "model", "parts": [response.text]})
-        
-        if user_id in FULL_HISTORY_ENABLED_USERS:
-            save_full_chat_history(user_id, current_history)
+        reply_text = response_cache.get(cache_key)
+        if reply_text is not None:
+            logger.info(f"Answered text message from {user_id} from the response cache.")
+            with metrics.timer('send'):
+                await send_long_message(update, reply_text)
         else:
-            save_chat_history(user_id, current_history)
-        
-        user_last_active[user_id] = datetime.now()
+            chat_session = session_manager.get(user_id, model, gemini_history)
+            reply_text = await generate_reply(update, chat_session, user_message)
+            response_cache.put(cache_key, reply_text, len(reply_text.encode('utf-8')))
         
-        await send_long_message(update, final_text)
-    except BlockedPromptException as e:
-        logger.warning(f"Blocked content detected for user {user_id}: {e}")
-        await update.message.reply_text("Sorry, your request contains content that was blocked due to safety settings.")
+        with metrics.timer('history_save'):
+            await save_turn(user_id, [
+                {"role": "user", "parts": [user_message]},
+                {"role": "model", "parts": [reply_text]},
+            ], chat_session)
     except Exception as e:
-        logger.error(f"Error processing text message from {user_id}: {e}", exc_info=True)
-        await update.message.reply_text(f"An error occurred while processing your request: {e}")
+        await report_processing_error(update, e, "text message", "request")
 
-async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.message.from_user.id
-    caption_prompt = update.message.caption or ""
-    logger.info(f"User {user_id} sent photo with caption: {caption_prompt}")
-    
-    spam_check_content = caption_prompt if caption_prompt else f"photo__{update.message.photo[-1].file_id}"
-    if await check_spam(update, spam_check_content):
+async def release_media_when_done(media_task: asyncio.Task):
+    try:
+        media_part, media_cached = await media_task
+    except (Exception, asyncio.CancelledError):
         return
-        
-    await cleanup_old_sessions()
-    
-    await update.message.reply_text("Received image, processing...")
-    await update.message.chat.send_action(ChatAction.UPLOAD_PHOTO)
-    
-    file_id = update.message.photo[-1].file_id
-    file = await context.bot.get_file(file_id)
-    
-    uploaded_file = None
-    
-    current_history = []
-    if user_id in FULL_HISTORY_ENABLED_USERS:
-        current_history = load_full_chat_history(user_id)
-        logger.info(f"Loaded FULL chat history for user {user_id} (vision/audio).")
-    else:
-        current_history = load_chat_history(user_id)
-        logger.info(f"Loaded standard chat history for user {user_id} (vision/audio).")
+    if not media_cached:
+        gemini_file_janitor.release(media_part)
 
-    gemini_history = INITIAL_HTML_INSTRUCTION + current_history
+async def process_media(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, status_text: str, action: str, media_key: str, prompt: list, user_turn: str):
+    user_id = update.message.from_user.id
+    notify = asyncio.gather(send_status(update.message, status_text), send_action(update.message, action), return_exceptions=True)
+    media_task = asyncio.create_task(load_message_media(context, update.message))
 
+    chat_session = None
     try:
-        with BytesIO() as bio:
-            await file.download_to_memory(bio)
-            bio.seek(0)
-            image = Image.open(bio)
-            
-            img_byte_arr = BytesIO()
-            image.save(img_byte_arr, format='JPEG')
-            img_byte_arr.seek(0)
-
-            uploaded_file = genai.upload_file(path=img_byte_arr, display_name=f"{file_id}.jpg", mime_type="image/jpeg")
-            logger.info(f"Photo uploaded to Gemini: {uploaded_file.name}")
-
-        chat_session = vision_audio_model.start_chat(history=gemini_history)
-            
-        user_last_active[user_id] = datetime.now()
-        
-        request_content = [uploaded_file, caption_prompt] if caption_prompt else [uploaded_file]
-        response = await chat_session.send_message_async(request_content, safety_settings=safety_settings)
-        final_text = clean_text_for_telegram(response.text)
-        
-        current_history.append({"role": "user", "parts": [caption_prompt if caption_prompt else "User sent an image."]})
-        current_history.append({"role": "model", "parts": [response.text]})
-        
-        if user_id in FULL_HISTORY_ENABLED_USERS:
-            save_full_chat_history(user_id, current_history)
+        with metrics.timer('history_load'):
+            current_history = await history_store.load_context(user_id)
+        history_kind = "FULL" if user_id in FULL_HISTORY_ENABLED_USERS else "standard"
+        logger.info(f"Loaded {history_kind} chat history for user {user_id} ({kind}).")
+
+        gemini_history = INITIAL_HTML_INSTRUCTION + current_history
+        cache_key = make_response_cache_key(vision_audio_model, gemini_history, [media_key] + prompt)
+        reply_text = response_cache.get(cache_key)
+        if reply_text is not None:
+            logger.info(f"Answered {kind} from {user_id} from the response cache.")
+            media_task.cancel()
+            with metrics.timer('send'):
+                await send_long_message(update, reply_text)
         else:
-            save_chat_history(user_id, current_history)
+            media_part, _ = await media_task
+            chat_session = session_manager.get(user_id, vision_audio_model, gemini_history)
+            reply_text = await generate_reply(update, chat_session, [media_part] + prompt)
+            response_cache.put(cache_key, reply_text, len(reply_text.encode('utf-8')))
 
-        await send_long_message(update, final_text)
-        
-    except BlockedPromptException as e:
-        logger.warning(f"Blocked content detected for user {user_id}: {e}")
-        await update.message.reply_text("Sorry, your request contains content that was blocked due to safety settings.")
+        with metrics.timer('history_save'):
+            await save_turn(user_id, [
+                {"role": "user", "parts": [user_turn]},
+                {"role": "model", "parts": [reply_text]},
+            ], chat_session)
     except Exception as e:
-        logger.error(f"Error processing photo from {user_id}: {e}", exc_info=True)
-        await update.message.reply_text(f"An error occurred while processing your photo: {e}")
+        await report_processing_error(update, e, kind, kind)
     finally:
-        if uploaded_file and hasattr(uploaded_file, 'name'):
-            try:
-                await genai.delete_file_async(uploaded_file.name)
-                logger.info(f"Deleted Gemini file {uploaded_file.name}")
-            except Exception as e:
-                logger.error(f"Error deleting Gemini file {uploaded_file.name}: {e}")
+        await notify
+        lifecycle.track_task(asyncio.create_task(release_media_when_done(media_task)))
 
-async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.message.from_user.id
-    logger.info(f"User {user_id} sent voice message.")
-    
-    spam_check_content = f"voice__{update.message.voice.file_id}"
-    if await check_spam(update, spam_check_content):
-        return
+@instrumented('photo')
+async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    caption_prompt = update.message.caption or ""
+    photo = select_photo_size(update.message.photo)
+    await process_media(
+        update, context, "photo", "Received image, processing...", ChatAction.UPLOAD_PHOTO,
+        f"photo:{photo.file_unique_id}", [caption_prompt] if caption_prompt else [], caption_prompt or "User sent an image.",
+    )
 
-    await cleanup_old_sessions()
+@instrumented('voice')
+async def process_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await process_media(
+        update, context, "voice message", "Received voice message, processing...", ChatAction.UPLOAD_VOICE,
+        f"voice:{update.message.voice.file_unique_id}", [VOICE_PROMPT], f"User sent a voice message. Context prompt: {VOICE_PROMPT}",
+    )
 
-    await update.message.reply_text("Received voice message, processing...")
-    await update.message.chat.send_action(ChatAction.UPLOAD_VOICE)
-    
-    file_id = update.message.voice.file_id
-    file = await context.bot.get_file(file_id)
-    
-    uploaded_file = None
+def group_media_albums(updates: list) -> list:
+    groups = []
+    for update in updates:
+        media_group_id = update.message.media_group_id
+        if media_group_id and groups and groups[-1][0].message.media_group_id == media_group_id:
+            groups[-1].append(update)
+        else:
+            groups.append([update])
+    return groups
 
-    current_history = []
-    if user_id in FULL_HISTORY_ENABLED_USERS:
-        current_history = load_full_chat_history(user_id)
-        logger.info(f"Loaded FULL chat history for user {user_id} (voice).")
-    else:
-        current_history = load_chat_history(user_id)
-        logger.info(f"Loaded standard chat history for user {user_id} (voice).")
-    
-    gemini_history = INITIAL_HTML_INSTRUCTION + current_history
-    
+@instrumented('burst')
+async def process_burst(updates: list, context: ContextTypes.DEFAULT_TYPE) -> None:
+    last_update = updates[-1]
+    user_id = last_update.message.from_user.id
+    metrics.increment('bot_coalesced_messages_total', amount=len(updates))
+    logger.info(f"Combining {len(updates)} messages from user {user_id} into one request.")
+
+    has_media = any(update.message.photo or update.message.voice for update in updates)
+    media_loads = asyncio.gather(
+        *(load_message_media(context, update.message) for update in updates if update.message.photo or update.message.voice),
+        return_exceptions=True,
+    )
+
+    chat_session = None
     try:
-        with BytesIO() as bio:
-            await file.download_to_memory(bio)
-            bio.seek(0)
-            uploaded_file = genai.upload_file(path=bio, display_name=f"{file_id}.ogg", mime_type="audio/ogg")
-            logger.info(f"Voice message uploaded to Gemini: {uploaded_file.name}")
-
-        chat_session = vision_audio_model.start_chat(history=gemini_history)
-            
-        user_last_active[user_id] = datetime.now()
-        
-        prompt_for_gemini = "Transcribe the following voice message, and then respond to its content."
-        response = await chat_session.send_message_async([uploaded_file, prompt_for_gemini], safety_settings=safety_settings)
-        final_text = clean_text_for_telegram(response.text)
+        with metrics.timer('history_load'):
+            current_history = await history_store.load_context(user_id)
+        gemini_history = INITIAL_HTML_INSTRUCTION + current_history
+        loaded = await media_loads
+        media = [result for result in loaded if not isinstance(result, BaseException)]
+        for result in loaded:
+            if isinstance(result, BaseException):
+                raise result
 
-        current_history.append({"role": "user", "parts": [f"User sent a voice message. Context prompt: {prompt_for_gemini}"]})
-        current_history.append({"role": "model", "parts": [response.text]})
-        
-        if user_id in FULL_HISTORY_ENABLED_USERS:
-            save_full_chat_history(user_id, current_history)
-        else:
-            save_chat_history(user_id, current_history)
+        media_parts = iter(media)
+        request_content = []
+        user_parts = []
+        for group in group_media_albums(updates):
+            message = group[0].message
+            if len(group) > 1:
+                request_content.extend(next(media_parts)[0] for _ in group)
+                caption = "\n".join(update.message.caption for update in group if update.message.caption)
+                if caption:
+                    request_content.append(caption)
+                user_parts.append(caption or f"User sent an album of {len(group)} images.")
+            elif message.photo:
+                request_content.append(next(media_parts)[0])
+                if message.caption:
+                    request_content.append(message.caption)
+                user_parts.append(message.caption or "User sent an image.")
+            elif message.voice:
+                request_content.extend([next(media_parts)[0], VOICE_PROMPT])
+                user_parts.append(f"User sent a voice message. Context prompt: {VOICE_PROMPT}")
+            else:
+                request_content.append(message.text)
+                user_parts.append(message.text)
 
-        await send_long_message(update, final_text)
-        
-    except BlockedPromptException as e:
-        logger.warning(f"Blocked content detected for user {user_id}: {e}")
-        await update.message.reply_text("Sorry, your request contains content that was blocked due to safety settings.")
+        model = vision_audio_model if has_media else select_text_model("\n".join(user_parts))
+        chat_session = session_manager.get(user_id, model, gemini_history)
+        reply_text = await generate_reply(last_update, chat_session, request_content)
+
+        with metrics.timer('history_save'):
+            await save_turn(user_id, [
+                {"role": "user", "parts": ["\n".join(user_parts)]},
+                {"role": "model", "parts": [reply_text]},
+            ], chat_session)
     except Exception as e:
-        logger.error(f"Error processing voice message from {user_id}: {e}", exc_info=True)
-        await update.message.reply_text(f"An error occurred while processing your voice message: {e}")
+        await report_processing_error(last_update, e, "message burst", "messages")
     finally:
-        if uploaded_file and hasattr(uploaded_file, 'name'):
-            try:
-                await genai.delete_file_async(uploaded_file.name)
-                logger.info(f"Deleted Gemini file {uploaded_file.name}")
-            except Exception as e:
-                logger.error(f"Error deleting Gemini file {uploaded_file.name}: {e}")
+        for result in await media_loads:
+            if not isinstance(result, BaseException) and not result[1]:
+                gemini_file_janitor.release(result[0])
 
+@instrumented('unhandled')
 async def unhandled_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info(f"User {update.message.from_user.id} sent an unhandled message type.")
-    await update.message.reply_text("Sorry, I can only process text messages, photos, and voice messages.")
+    await send_text(update.message, "Sorry, I can only process text messages, photos, and voice messages.")
 
-def restart_bot():
-    logger.info("Restarting bot...")
-    python = sys.executable
-    os.execl(python, python, *sys.argv)
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
 
-def schedule_restart():
-    threading.Timer(3600, restart_bot).start()
+async def read_http_headers(reader: asyncio.StreamReader) -> dict:
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            return headers
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
 
-def main() -> None:
+async def serve_http(host: str, port: int, handler, ssl_context: ssl.SSLContext = None):
+    async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = await read_http_headers(reader)
+                length = int(headers.get('content-length') or 0)
+                if length > HTTP_MAX_BODY_BYTES:
+                    status, content_type, payload = 413, 'text/plain', b''
+                    headers['connection'] = 'close'
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    try:
+                        status, content_type, payload = await handler(method, path, headers, body)
+                    except Exception as e:
+                        logger.error(f"HTTP handler failed for {method} {path}: {e}", exc_info=True)
+                        status, content_type, payload = 500, 'text/plain', b''
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'Unknown')}\r\n"
+                    f"Content-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle_connection, host, port, ssl=ssl_context)
+
+def build_webhook_ssl_context():
+    if not WEBHOOK_CERT:
+        return None
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(WEBHOOK_CERT, WEBHOOK_KEY or None)
+    return context
+
+class HttpConnection:
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.lock = None
+
+    async def request(self, method: str, path: str, body: bytes = b'', timeout: float = 10, headers: dict = None) -> tuple:
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            reused = self.writer is not None
+            try:
+                return await asyncio.wait_for(self.exchange(method, path, body, headers), timeout)
+            except ConnectionResetError:
+                self.close()
+                if not reused:
+                    raise
+                return await asyncio.wait_for(self.exchange(method, path, body, headers), timeout)
+            except Exception:
+                self.close()
+                raise
+
+    async def exchange(self, method: str, path: str, body: bytes, headers: dict = None) -> tuple:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        extra_headers = "".join(f"{name}: {value}\r\n" for name, value in (headers or {}).items())
+        self.writer.write(
+            f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Type: application/json\r\n{extra_headers}"
+            f"Content-Length: {len(body)}\r\n\r\n".encode('latin-1') + body
+        )
+        await self.writer.drain()
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed before a response was received.")
+        headers = await read_http_headers(self.reader)
+        payload = await self.reader.readexactly(int(headers.get('content-length') or 0))
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+        return int(status_line.split()[1]), payload
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+def get_raw_update_user_id(data: dict):
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        sender = value.get('from') or value.get('user') or value.get('chat')
+        if isinstance(sender, dict) and 'id' in sender:
+            return sender['id']
+    return None
+
+async def handle_worker_request(application: Application, method: str, path: str, headers: dict, body: bytes) -> tuple:
+    if method == 'GET' and path == '/healthz':
+        status = {'worker': WORKER_INDEX, 'in_flight': lifecycle.in_flight, 'queued': application.update_queue.qsize(), 'shutting_down': lifecycle.shutting_down}
+        return (503 if lifecycle.shutting_down else 200), 'application/json', json.dumps(status).encode()
+    if method != 'POST' or path != '/update':
+        return 404, 'text/plain', b''
+    if lifecycle.shutting_down:
+        return 503, 'text/plain', b''
+    await application.update_queue.put(Update.de_json(json.loads(body), application.bot))
+    return 200, 'text/plain', b'ok'
+
+async def refresh_full_history_users(context: ContextTypes.DEFAULT_TYPE):
+    users = await asyncio.to_thread(load_full_history_users)
+    if users != FULL_HISTORY_ENABLED_USERS:
+        FULL_HISTORY_ENABLED_USERS.clear()
+        FULL_HISTORY_ENABLED_USERS.update(users)
+        logger.info(f"Full history user list refreshed ({len(users)} users).")
+
+async def run_worker(index: int):
+    global WORKER_INDEX
+    WORKER_INDEX = index
+    worker_rate = TELEGRAM_GLOBAL_MESSAGES_PER_SECOND / WEBHOOK_WORKERS
+    outbox.global_bucket = TokenBucket(worker_rate, worker_rate)
+    lifecycle.finished = asyncio.Event()
+    application = build_application()
+    application.job_queue.run_repeating(refresh_full_history_users, interval=FULL_HISTORY_REFRESH_INTERVAL)
+    async with application:
+        await post_init(application)
+        await application.start()
+        server = await serve_http('127.0.0.1', WORKER_BASE_PORT + index, partial(handle_worker_request, application))
+        logger.info(f"Worker {index} listening on 127.0.0.1:{WORKER_BASE_PORT + index}.")
+        await lifecycle.finished.wait()
+        server.close()
+        await application.stop()
+    await post_shutdown(application)
+
+class WorkerProcess:
+    def __init__(self, index: int):
+        self.index = index
+        self.port = WORKER_BASE_PORT + index
+        self.connection = HttpConnection('127.0.0.1', self.port)
+        self.process = None
+        self.healthy = False
+        self.restarts = 0
+        self.started_at = 0.0
+        self.respawn_at = 0.0
+
+    async def spawn(self):
+        self.process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), 'worker', str(self.index))
+        self.started_at = time.monotonic()
+        self.healthy = False
+        logger.info(f"Started worker {self.index} (pid {self.process.pid}).")
+
+    async def check_health(self):
+        try:
+            status, _ = await self.connection.request('GET', '/healthz', timeout=WORKER_HEALTH_CHECK_TIMEOUT)
+            self.healthy = status == 200
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            self.healthy = False
+
+    def send_signal(self, signum: int):
+        if self.process and self.process.returncode is None:
+            self.process.send_signal(signum)
+
+class WebhookFront:
+    def __init__(self, worker_count: int):
+        self.workers = [WorkerProcess(index) for index in range(worker_count)]
+        self.stopping = False
+
+    def worker_for(self, data: dict) -> WorkerProcess:
+        return self.workers[(get_raw_update_user_id(data) or 0) % len(self.workers)]
+
+    async def handle_request(self, method: str, path: str, headers: dict, body: bytes) -> tuple:
+        if method == 'GET' and path == '/healthz':
+            status = {'workers': [{'index': worker.index, 'healthy': worker.healthy, 'restarts': worker.restarts} for worker in self.workers]}
+            healthy = not self.stopping and all(worker.healthy for worker in self.workers)
+            return (200 if healthy else 503), 'application/json', json.dumps(status).encode()
+        if method != 'POST' or path != WEBHOOK_PATH:
+            return 404, 'text/plain', b''
+        if WEBHOOK_SECRET_TOKEN and headers.get('x-telegram-bot-api-secret-token') != WEBHOOK_SECRET_TOKEN:
+            return 403, 'text/plain', b''
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400, 'text/plain', b''
+        worker = self.worker_for(data)
+        try:
+            status, _ = await worker.connection.request('POST', '/update', body)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            logger.warning(f"Worker {worker.index} unavailable for update {data.get('update_id')}: {e}")
+            worker.healthy = False
+            status = 503
+        return status, 'text/plain', b''
+
+    async def monitor(self):
+        while not self.stopping:
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.process.returncode is None:
+                    await worker.check_health()
+                    continue
+                worker.healthy = False
+                if not worker.respawn_at:
+                    crashed_fast = now - worker.started_at < WORKER_MIN_UPTIME
+                    delay = min(2 ** worker.restarts, WORKER_MAX_RESPAWN_DELAY) if crashed_fast else 0
+                    worker.restarts = worker.restarts + 1 if crashed_fast else 0
+                    worker.respawn_at = now + delay
+                    logger.warning(f"Worker {worker.index} exited with code {worker.process.returncode}; respawning in {delay}s.")
+                if now >= worker.respawn_at and not self.stopping:
+                    worker.respawn_at = 0.0
+                    await worker.spawn()
+            pending_respawns = [worker.respawn_at - now for worker in self.workers if worker.respawn_at]
+            await asyncio.sleep(max(0.1, min([WORKER_HEALTH_CHECK_INTERVAL] + pending_respawns)))
+
+    async def stop_workers(self):
+        for worker in self.workers:
+            worker.connection.close()
+            worker.send_signal(signal.SIGTERM)
+        waits = [asyncio.ensure_future(worker.process.wait()) for worker in self.workers if worker.process]
+        if waits:
+            await asyncio.wait(waits, timeout=SHUTDOWN_DRAIN_TIMEOUT + 15)
+        for worker in self.workers:
+            if worker.process and worker.process.returncode is None:
+                logger.warning(f"Worker {worker.index} did not stop in time; killing it.")
+                worker.process.kill()
+
+    async def run(self):
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        for signum in (signal.SIGHUP, signal.SIGUSR2):
+            loop.add_signal_handler(signum, partial(self.broadcast_signal, signum))
+
+        for worker in self.workers:
+            await worker.spawn()
+        ssl_context = build_webhook_ssl_context()
+        server = await serve_http(WEBHOOK_LISTEN, WEBHOOK_PORT, self.handle_request, ssl_context)
+        monitor_task = asyncio.create_task(self.monitor())
+        async with telegram.Bot(TELEGRAM_BOT_TOKEN, base_url=TELEGRAM_BASE_URL) as bot:
+            certificate = open(WEBHOOK_CERT, 'rb') if ssl_context else None
+            try:
+                await bot.set_webhook(WEBHOOK_URL, certificate=certificate, secret_token=WEBHOOK_SECRET_TOKEN, allowed_updates=Update.ALL_TYPES, max_connections=WEBHOOK_MAX_CONNECTIONS)
+            finally:
+                if certificate:
+                    certificate.close()
+        logger.info(f"Webhook receiver listening on {'https' if ssl_context else 'http'}://{WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH} with {len(self.workers)} workers.")
+
+        await stop.wait()
+        logger.info("Stopping webhook receiver and workers...")
+        self.stopping = True
+        monitor_task.cancel()
+        server.close()
+        await self.stop_workers()
+        logger.info("Webhook receiver stopped.")
+
+    def broadcast_signal(self, signum: int):
+        logger.info(f"Forwarding signal {signum} to all workers.")
+        for worker in self.workers:
+            worker.send_signal(signum)
+
+async def handle_metrics_request(method: str, path: str, headers: dict, body: bytes) -> tuple:
+    if method == 'GET' and path.split('?', 1)[0] == '/metrics':
+        return 200, 'text/plain; version=0.0.4', metrics.render_prometheus().encode()
+    return 404, 'text/plain', b'not found'
+
+def register_metrics_gauges():
+    metrics.gauge('bot_in_flight_requests', lambda: lifecycle.in_flight)
+    metrics.gauge('bot_background_tasks', lambda: len(lifecycle.background_tasks))
+    metrics.gauge('bot_outbound_pending', lambda: outbox.pending)
+    metrics.gauge('bot_resident_sessions', lambda: len(session_manager.sessions))
+    metrics.gauge('bot_media_cache_entries', lambda: len(media_cache.entries))
+    metrics.gauge('bot_media_cache_hits', lambda: media_cache.hits)
+    metrics.gauge('bot_media_cache_misses', lambda: media_cache.misses)
+    metrics.gauge('bot_response_cache_entries', lambda: len(response_cache.entries))
+    metrics.gauge('bot_response_cache_hits', lambda: response_cache.hits)
+    metrics.gauge('bot_response_cache_misses', lambda: response_cache.misses)
+    metrics.gauge('bot_open_model_circuits', lambda: sum(breaker.is_open() for breaker in model_router.breakers.values()))
+
+async def post_init(application: Application) -> None:
+    await history_store.start()
+    await gemini_file_janitor.start()
+    outbox.start()
+    install_signal_handlers(application)
+    register_metrics_gauges()
+    if METRICS_PORT:
+        port = METRICS_PORT + (WORKER_INDEX or 0)
+        application.bot_data['metrics_server'] = await serve_http(METRICS_HOST, port, handle_metrics_request)
+        logger.info(f"Metrics endpoint listening on http://{METRICS_HOST}:{port}/metrics")
+
+async def post_shutdown(application: Application) -> None:
+    metrics_server = application.bot_data.pop('metrics_server', None)
+    if metrics_server:
+        metrics_server.close()
+    await history_store.close()
+    history_backend.close()
+    await gemini_file_janitor.close()
+    await outbox.close()
+    await file_downloader.close()
+    rate_limiter.backend.close()
+    shutdown_image_process_pool()
+    logger.info("Chat history flushed to disk.")
+
+def install_signal_handlers(application: Application):
+    loop = asyncio.get_running_loop()
+    handlers = {
+        signal.SIGINT: lambda: lifecycle.request_shutdown(application),
+        signal.SIGTERM: lambda: lifecycle.request_shutdown(application),
+    }
+    if hasattr(signal, 'SIGHUP'):
+        handlers[signal.SIGHUP] = reload_configuration
+    if hasattr(signal, 'SIGUSR2'):
+        handlers[signal.SIGUSR2] = lambda: lifecycle.request_shutdown(application, restart=True)
+    for signum, handler in handlers.items():
+        try:
+            loop.add_signal_handler(signum, handler)
+        except (NotImplementedError, RuntimeError):
+            logger.info(f"Signal {signum} cannot be handled on this platform.")
+
+def hand_off_to_new_process():
+    logger.info("Handing off to a new bot process...")
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+def build_application(request: BaseRequest = None) -> Application:
+    builder = Application.builder().token(TELEGRAM_BOT_TOKEN).base_url(TELEGRAM_BASE_URL).base_file_url(TELEGRAM_BASE_FILE_URL)
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    else:
+        builder = builder.connect_timeout(30).read_timeout(30).write_timeout(30).pool_timeout(60).connection_pool_size(128)
     application = (
-        Application.builder()
-        .token(TELEGRAM_BOT_TOKEN)
-        .connect_timeout(30)
-        .read_timeout(30)
-        .write_timeout(30)
-        .pool_timeout(60)
-        .connection_pool_size(128)
+        builder
+        .concurrent_updates(UserOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
-    
+
+    application.add_handler(MessageHandler(filters.COMMAND, flush_message_burst), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("clear", clear_history))
     application.add_handler(CommandHandler("history", history_control))
+    application.add_handler(CommandHandler("cache", cache_control))
+    application.add_handler(CommandHandler("reload", reload_command))
+    application.add_handler(CommandHandler("restart", restart_command))
+    application.add_handler(CommandHandler("stats", stats_command))
     
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
     application.add_handler(MessageHandler(filters.VOICE, handle_voice))
     application.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, unhandled_message))
     
+    if application.job_queue is None:
+        raise RuntimeError('The job queue is not available. Install python-telegram-bot with the job-queue extra: pip install "python-telegram-bot[job-queue]"')
+    application.job_queue.run_repeating(expire_sessions, interval=SESSION_EXPIRY_CHECK_INTERVAL)
+    return application
+
+def main() -> None:
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise ValueError("WEBHOOK_URL must be set when BOT_MODE is webhook.")
+        asyncio.run(WebhookFront(WEBHOOK_WORKERS).run())
+        return
+
+    application = build_application()
     logger.info("Bot started successfully.")
-    
-    schedule_restart()
 
     try:
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        application.run_polling(allowed_updates=Update.ALL_TYPES, stop_signals=None)
     except Exception as e:
         logger.critical(f"Bot stopped with a critical error: {e}", exc_info=True)
     finally:
         logger.info("Bot stopped.")
 
+    if lifecycle.restart_requested:
+        hand_off_to_new_process()
+
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:] == ['migrate-history']:
+        migrate_json_history_to_sqlite()
+    elif sys.argv[1:2] == ['worker']:
+        asyncio.run(run_worker(int(sys.argv[2])))
+        if lifecycle.restart_requested:
+            hand_off_to_new_process()
+    else:
+        main()
@@ -0,0 +1,258 @@
+import re
+from html import unescape
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+TOKEN = re.compile(
+    r'\n(?P<blank>(?:[ \t]*\n)+)?(?P<indent>[ \t]*)(?:'
+    r'(?P<fence>```)(?P<language>[^\n]*)'
+    r'|(?P<heading>#{1,6}) [ \t]*'
+    r'|(?P<bullet>[*+-]) '
+    r'|(?P<quote>&gt;)[ \t]*'
+    r'|(?P<rule>---|\*\*\*|___)[ \t]*(?=\n)'
+    r')?'
+    r'|`(?P<code>[^`\n]+)`'
+    r'|\*\*(?P<bold>\S(?:.*?\S)??)\*\*'
+    r'|_(?<![\w*]_)_(?P<underline_bold>\S(?:.*?\S)??)__(?!\w)'
+    r'|\*(?<!\*\*)(?P<italic>[^\s*](?:.*?[^\s*])??)\*(?!\*)'
+    r'|_(?<![\w_]_)(?P<underscore_italic>[^\s_](?:.*?[^\s_])??)_(?![\w_])'
+    r'|~~(?P<strike>\S(?:.*?\S)??)~~'
+    r'|\|\|(?P<spoiler>\S(?:.*?\S)??)\|\|'
+    r'|\[(?P<link>[^\]\n]+)\]\((?P<url>(?:https?://|tg://|mailto:)[^\s)]+)\)'
+)
+FENCE_END = re.compile(r'\n[ \t]*```[^\n]*')
+INLINE_TAGS = {
+    'bold': ('<b>', '</b>'),
+    'underline_bold': ('<b>', '</b>'),
+    'italic': ('<i>', '</i>'),
+    'underscore_italic': ('<i>', '</i>'),
+    'strike': ('<s>', '</s>'),
+    'spoiler': ('<tg-spoiler>', '</tg-spoiler>'),
+}
+LINE_KINDS = {'indent', 'language', 'heading', 'bullet', 'quote', 'rule'}
+HTML_TAG = re.compile(r'<(/?)([a-z-]+)[^>]*>')
+CODE_LANGUAGE = re.compile(r'[\w#+.-]+')
+
+def escape_text(text: str) -> str:
+    if '&' in text or '<' in text or '>' in text:
+        return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return text
+
+def render_code_block(match, text: str) -> tuple:
+    body_start = match.end() + 1
+    close = FENCE_END.search(text, match.end())
+    if close:
+        code, end = text[body_start:close.start()], close.end()
+    else:
+        code, end = text[body_start:len(text) - 1], len(text) - 1
+    indent = len(match.group('indent'))
+    if indent and code:
+        code = '\n'.join(line[indent:] if line[:indent].isspace() else line for line in code.split('\n'))
+    language = CODE_LANGUAGE.fullmatch(match.group('language').strip())
+    if language:
+        return ['<pre>', f'<code class="language-{language.group(0)}">', code, '</code>', '</pre>'], end
+    return ['<pre>', code, '</pre>'], end
+
+def tokenize_blocks(text: str) -> list:
+    text = f"\n{escape_text(text)}\n"
+    search = TOKEN.search
+    blocks = []
+    block = None
+    line_kind = None
+    stack = []
+    position = 0
+    end = len(text)
+    while True:
+        match = search(text, position, end)
+        if match is None:
+            if not stack:
+                break
+            if position < end:
+                block.append(text[position:end])
+            close, position, end = stack.pop()
+            block.append(close)
+            continue
+
+        start = match.start()
+        kind = match.lastgroup
+        if kind not in LINE_KINDS:
+            if start > position:
+                block.append(text[position:start])
+            position = match.end()
+            if kind == 'code':
+                block += ('<code>', match.group('code'), '</code>')
+                continue
+            if kind == 'url':
+                url = match.group('url').replace('"', '&quot;').replace("'", '&#x27;')
+                opening, close, inner = f'<a href="{url}">', '</a>', 'link'
+            else:
+                (opening, close), inner = INLINE_TAGS[kind], kind
+            inner_start, inner_end = match.span(inner)
+            if search(text, inner_start, inner_end) is None:
+                block += (opening, text[inner_start:inner_end], close)
+                continue
+            block.append(opening)
+            stack.append((close, position, end))
+            position, end = inner_start, inner_end
+            continue
+
+        tail = text[position:start].rstrip()
+        if tail:
+            block.append(tail)
+        if line_kind == 'heading':
+            block.append('</b>')
+        if line_kind == 'plain' or line_kind == 'heading':
+            blocks.append(block)
+        position = match.end()
+        blank = match.start('blank') != -1
+
+        if kind == 'quote' and not blank and line_kind == 'quote':
+            block.append('\n')
+            continue
+        if line_kind == 'quote':
+            block.append('</blockquote>')
+            blocks.append(block)
+        if blank and blocks:
+            blocks.append([''])
+
+        if kind == 'indent':
+            block = [match.group('indent')]
+            line_kind = 'plain'
+        elif kind == 'bullet':
+            block = [match.group('indent'), '• ']
+            line_kind = 'plain'
+        elif kind == 'heading':
+            block = ['<b>']
+            line_kind = 'heading'
+        elif kind == 'quote':
+            block = ['<blockquote>']
+            line_kind = 'quote'
+        elif kind == 'rule':
+            block = ['——————']
+            line_kind = 'plain'
+        else:
+            code_block, position = render_code_block(match, text)
+            blocks.append(code_block)
+            block = None
+            line_kind = 'code'
+
+    while blocks and blocks[-1] == ['']:
+        blocks.pop()
+    return blocks
+
+def render_blocks(text: str) -> list:
+    return [''.join(pieces) for pieces in tokenize_blocks(text)]
+
+def render_markdown(text: str) -> str:
+    return '\n'.join(render_blocks(text))
+
+def render_chunks(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+    chunks = []
+    current = []
+    size = -1
+    for pieces in tokenize_blocks(text):
+        block = ''.join(pieces)
+        if size + 1 + len(block) <= limit:
+            current.append(block)
+            size += 1 + len(block)
+            continue
+        if current:
+            chunks.append('\n'.join(current).strip('\n'))
+        if len(block) > limit:
+            parts = split_block(pieces, limit) or ['']
+            chunks.extend(parts[:-1])
+            block = parts[-1]
+        current = [block]
+        size = len(block)
+    if current:
+        chunks.append('\n'.join(current).strip('\n'))
+    return [chunk for chunk in chunks if chunk]
+
+def safe_cut(text: str, limit: int) -> int:
+    cut = text.rfind('\n', 0, limit + 1)
+    if cut <= 0:
+        cut = text.rfind(' ', 0, limit + 1)
+    if cut <= 0:
+        cut = limit
+    entity = text.rfind('&', 0, cut)
+    if entity != -1 and text.find(';', entity, cut) == -1:
+        cut = entity
+    return cut
+
+def closing_tag(tag: str) -> str:
+    return f"</{tag[1:].split(' ', 1)[0].rstrip('>')}>"
+
+def split_block(pieces: list, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+    chunks = []
+    stack = []
+    output = []
+    size = 0
+    has_text = False
+    closing_size = 0
+
+    def flush():
+        nonlocal output, size, has_text
+        if has_text:
+            chunks.append(''.join(output) + ''.join(close for _, close in reversed(stack)))
+        output = [tag for tag, _ in stack]
+        size = sum(len(tag) for tag in output)
+        has_text = False
+
+    def drop_open_tags():
+        nonlocal output, size, closing_size
+        stack.clear()
+        output = []
+        size = 0
+        closing_size = 0
+
+    def add_text(text: str):
+        nonlocal size, has_text
+        while text:
+            room = limit - size - closing_size
+            if len(text) <= room:
+                output.append(text)
+                size += len(text)
+                has_text = has_text or bool(text.strip())
+                return
+            if room <= 0 and not has_text:
+                drop_open_tags()
+                continue
+            if room <= 0 or (has_text and '\n' not in text[:room + 1]):
+                flush()
+                continue
+            cut = safe_cut(text, room)
+            if cut <= 0:
+                if has_text:
+                    flush()
+                    continue
+                if stack:
+                    drop_open_tags()
+                    continue
+                cut = room
+            output.append(text[:cut])
+            size += cut
+            has_text = has_text or bool(text[:cut].strip())
+            flush()
+            text = text[cut + 1:] if text[cut:cut + 1] == '\n' else text[cut:]
+
+    for piece in pieces:
+        if piece[:1] != '<':
+            add_text(piece)
+        elif piece[1] == '/':
+            if stack and stack[-1][1] == piece:
+                stack.pop()
+                closing_size -= len(piece)
+                output.append(piece)
+                size += len(piece)
+        else:
+            close = closing_tag(piece)
+            if size + len(piece) + closing_size + len(close) > limit:
+                flush()
+            stack.append((piece, close))
+            closing_size += len(close)
+            output.append(piece)
+            size += len(piece)
+    flush()
+    return chunks
+
+def html_to_text(html: str) -> str:
+    return unescape(HTML_TAG.sub('', html))
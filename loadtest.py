@@ -0,0 +1,419 @@
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from google.api_core.exceptions import ResourceExhausted, ServiceUnavailable
+from google.generativeai.types import BlockedPromptException
+
+from bench_formatting import generate_reply as generate_markdown, sentence
+
+CHARS_PER_TOKEN = 4
+STREAM_CHUNK_TOKENS = 20
+BASE_USER_ID = 900000000
+
+class StubChunk:
+    def __init__(self, text: str = None):
+        parts = [SimpleNamespace(text=text)] if text is not None else []
+        self.candidates = [SimpleNamespace(content=SimpleNamespace(parts=parts))]
+
+    @property
+    def text(self) -> str:
+        if not self.candidates[0].content.parts:
+            raise ValueError("The response has no parts; only finish_reason and usage metadata were returned.")
+        return self.candidates[0].content.parts[0].text
+
+class StubResponse:
+    def __init__(self, chunks: list, chunk_delay: float, on_complete=None):
+        self.chunks = chunks
+        self.chunk_delay = chunk_delay
+        self.on_complete = on_complete
+        self.text = ''.join(chunks)
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            await asyncio.sleep(self.chunk_delay)
+            yield StubChunk(chunk)
+        yield StubChunk()
+        if self.on_complete:
+            self.on_complete(self)
+
+class StubUploadedFile:
+    def __init__(self, name: str):
+        self.name = name
+
+class StubGemini:
+    def __init__(self, latency: float, jitter: float, tokens_per_second: float, reply_tokens: int,
+                 error_rate: float = 0, quota_rate: float = 0, blocked_rate: float = 0, upload_latency: float = 0.2, seed: int = 0,
+                 model_latency: dict = None, model_error_rate: dict = None):
+        self.latency = latency
+        self.model_latency = model_latency or {}
+        self.model_error_rate = model_error_rate or {}
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.quota_rate = quota_rate
+        self.blocked_rate = blocked_rate
+        self.upload_latency = upload_latency
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.failures = {}
+        self.uploads = 0
+        self.active = 0
+        self.peak_active = 0
+        self.model_requests = {}
+
+    def model(self, name: str):
+        return StubModel(self, name)
+
+    def inject_error(self, model: str):
+        roll = self.rng.random()
+        for rate, kind, error in (
+            (self.quota_rate, 'quota', lambda: ResourceExhausted("Stub quota exceeded")),
+            (self.blocked_rate, 'blocked', lambda: BlockedPromptException("Stub prompt blocked")),
+            (self.model_error_rate.get(model, self.error_rate), 'error', lambda: ServiceUnavailable(f"Stub model {model} unavailable")),
+        ):
+            if roll < rate:
+                self.failures[kind] = self.failures.get(kind, 0) + 1
+                raise error()
+            roll -= rate
+
+    def reply_chunks(self) -> list:
+        tokens = max(1, int(self.rng.gauss(self.reply_tokens, self.reply_tokens / 4)))
+        text = generate_markdown(tokens * CHARS_PER_TOKEN, self.rng.randrange(1 << 30))
+        size = STREAM_CHUNK_TOKENS * CHARS_PER_TOKEN
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    async def respond(self, model: str, stream: bool, on_complete=None) -> StubResponse:
+        self.requests += 1
+        self.model_requests[model] = self.model_requests.get(model, 0) + 1
+        self.active += 1
+        self.peak_active = max(self.peak_active, self.active)
+        try:
+            await asyncio.sleep(max(0.0, self.rng.gauss(self.model_latency.get(model, self.latency), self.jitter)))
+            self.inject_error(model)
+            chunks = self.reply_chunks()
+            chunk_delay = STREAM_CHUNK_TOKENS / self.tokens_per_second
+            if stream:
+                return StubResponse(chunks, chunk_delay, on_complete)
+            await asyncio.sleep(chunk_delay * len(chunks))
+            response = StubResponse(chunks, 0)
+            if on_complete:
+                on_complete(response)
+            return response
+        finally:
+            self.active -= 1
+
+    def upload_file(self, path=None, display_name=None, mime_type=None):
+        self.uploads += 1
+        time.sleep(self.upload_latency)
+        return StubUploadedFile(f"files/stub-{self.uploads}")
+
+    def delete_file(self, name):
+        time.sleep(self.upload_latency / 4)
+
+class StubModel:
+    def __init__(self, backend: StubGemini, name: str):
+        self.backend = backend
+        self.name = name
+        self.model_name = f"models/{name}"
+
+    def start_chat(self, history=None):
+        return StubChatSession(self, list(history or []))
+
+    async def generate_content_async(self, contents, safety_settings=None, stream=False):
+        return await self.backend.respond(self.name, stream)
+
+class StubChatSession:
+    def __init__(self, model: StubModel, history: list):
+        self.model = model
+        self.history = history
+
+    async def send_message_async(self, content, safety_settings=None, stream=False):
+        parts = content if isinstance(content, list) else [content]
+
+        def record(response):
+            self.history = self.history + [{"role": "user", "parts": parts}, {"role": "model", "parts": [response.text]}]
+
+        return await self.model.backend.respond(self.model.name, stream, record)
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for item in text.split(','):
+        kind, _, weight = item.partition('=')
+        mix[kind.strip()] = float(weight)
+    unknown = set(mix) - {'text', 'photo', 'voice'}
+    if unknown:
+        raise ValueError(f"unknown message kinds: {', '.join(sorted(unknown))}")
+    return mix
+
+def make_update(update_id: int, user_id: int, kind: str, rng: random.Random, media_group_id: str = None, caption: bool = None) -> dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": f"Load{user_id}"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"Load{user_id}"},
+    }
+    if kind == 'photo':
+        message["photo"] = [
+            {"file_id": f"photo-{update_id}-{width}", "file_unique_id": f"p{update_id}x{width}", "width": width, "height": width * 3 // 4, "file_size": width * width // 8}
+            for width in (320, 800, 1280)
+        ]
+        if media_group_id:
+            message["media_group_id"] = media_group_id
+        if caption is None:
+            caption = rng.random() < 0.5
+        if caption:
+            message["caption"] = sentence(rng)
+    elif kind == 'voice':
+        message["voice"] = {"file_id": f"voice-{update_id}", "file_unique_id": f"v{update_id}", "duration": rng.randint(1, 30), "mime_type": "audio/ogg", "file_size": 16000}
+    else:
+        message["text"] = f"{sentence(rng)} ({update_id})"
+    return {"update_id": update_id, "message": message}
+
+def generate_updates(users: int, messages: int, mix: dict, burst: int, burst_gap: float, think_time: float, album_rate: float = 0, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    clocks = {BASE_USER_ID + index: rng.expovariate(1 / think_time) for index in range(users)}
+    arrivals = []
+    while len(arrivals) < messages:
+        user_id = min(clocks, key=clocks.get)
+        at = clocks[user_id]
+        for _ in range(rng.randint(1, burst)):
+            kind = rng.choices(kinds, weights)[0]
+            if kind == 'photo' and rng.random() < album_rate:
+                media_group_id = f"album-{len(arrivals)}"
+                for position in range(rng.randint(2, 10)):
+                    arrivals.append((at, user_id, kind, media_group_id, position == 0 and rng.random() < 0.7))
+                    at += 0.02
+            else:
+                arrivals.append((at, user_id, kind, None, None))
+            at += rng.expovariate(1 / burst_gap)
+        clocks[user_id] = at + rng.expovariate(1 / think_time)
+    arrivals.sort(key=lambda arrival: arrival[0])
+    return [
+        (at, make_update(index + 1, user_id, kind, rng, media_group_id, caption))
+        for index, (at, user_id, kind, media_group_id, caption) in enumerate(arrivals[:messages])
+    ]
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def current_rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024
+
+async def monitor_loop_lag(samples: list, interval: float = 0.01):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+def load_bot(workdir: str):
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:loadtest")
+    os.environ.setdefault("GEMINI_API_KEY", "loadtest")
+    os.environ.setdefault("ADMIN_USER_ID", "1")
+    os.chdir(workdir)
+    return importlib.import_module('bot'), importlib.import_module('replay_updates')
+
+def parse_model_values(items: list) -> dict:
+    values = {}
+    for item in items or []:
+        name, _, value = item.partition('=')
+        values[name.strip()] = float(value)
+    return values
+
+def install_stubs(bot, backend: StubGemini):
+    bot.genai.GenerativeModel = backend.model
+    bot.build_models()
+    bot.genai.upload_file = backend.upload_file
+    bot.genai.delete_file = backend.delete_file
+
+def time_updates(bot, application, update_kind, started_at: dict, latencies: dict):
+    buffered = set()
+
+    def record(update):
+        arrived = started_at.pop(update.update_id, None)
+        if arrived is not None:
+            latencies.setdefault(update_kind(update), []).append(time.perf_counter() - arrived)
+
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            callback = handler.callback
+
+            async def timed(update, context, callback=callback):
+                try:
+                    return await callback(update, context)
+                finally:
+                    if update.update_id not in buffered:
+                        record(update)
+
+            handler.callback = timed
+
+    add_to_burst = bot.MessageBurst.add
+    process_burst = bot.message_bursts.process
+
+    def add(burst, update, process):
+        buffered.add(update.update_id)
+        add_to_burst(burst, update, process)
+
+    async def process(burst):
+        try:
+            await process_burst(burst)
+        finally:
+            for update, _ in burst.items:
+                buffered.discard(update.update_id)
+                record(update)
+
+    bot.MessageBurst.add = add
+    bot.message_bursts.process = process
+
+async def run_load(bot, replay, updates: list, backend: StubGemini, telegram_latency: float, photo_size: int) -> dict:
+    api = replay.FakeBotApi(photo_size=photo_size, record=False)
+
+    class LatencyRequest(replay.ReplayRequest):
+        async def do_request(self, *args, **kwargs):
+            await asyncio.sleep(telegram_latency)
+            return await super().do_request(*args, **kwargs)
+
+    def update_kind(update):
+        message = update.message
+        return 'photo' if message.photo else 'voice' if message.voice else 'text'
+
+    application = bot.build_application(request=LatencyRequest(api))
+    bot.file_downloader.transport = replay.file_transport(api, telegram_latency)
+    started_at = {}
+    latencies = {}
+    lag_samples = []
+    time_updates(bot, application, update_kind, started_at, latencies)
+
+    rss_start = current_rss_mb()
+    async with application:
+        await bot.post_init(application)
+        await application.start()
+        lag_monitor = asyncio.create_task(monitor_loop_lag(lag_samples))
+        began = time.perf_counter()
+        for at, data in updates:
+            delay = began + at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            update = bot.Update.de_json(data, application.bot)
+            started_at[update.update_id] = time.perf_counter()
+            await application.update_queue.put(update)
+        await replay.wait_until_idle(application)
+        elapsed = time.perf_counter() - began
+        lag_monitor.cancel()
+        rss_end = current_rss_mb()
+        await application.stop()
+    await bot.post_shutdown(application)
+
+    completed = sum(len(values) for values in latencies.values())
+    return {
+        "updates": len(updates),
+        "completed": completed,
+        "elapsed_seconds": elapsed,
+        "messages_per_second": completed / elapsed if elapsed else 0.0,
+        "latency": {
+            kind: {"count": len(values), "p50": percentile(values, 0.5), "p95": percentile(values, 0.95), "p99": percentile(values, 0.99), "max": max(values)}
+            for kind, values in sorted(latencies.items()) + [('all', [value for values in latencies.values() for value in values])]
+            if values
+        },
+        "loop_lag": {"p50": percentile(lag_samples, 0.5), "p99": percentile(lag_samples, 0.99), "max": max(lag_samples, default=0.0)},
+        "rss_mb": {"start": rss_start, "end": rss_end, "peak": peak_rss_mb()},
+        "gemini": {"requests": backend.requests, "by_model": dict(sorted(backend.model_requests.items())), "peak_concurrency": backend.peak_active, "uploads": backend.uploads, "injected_failures": backend.failures},
+        "telegram_calls": dict(sorted(api.method_counts.items())),
+        "counters": {
+            f"{name}{''.join(f'[{value}]' for _, value in labels)}": value
+            for (name, labels), value in sorted(bot.metrics.counters.items())
+            if name != 'bot_updates_total'
+        },
+    }
+
+def print_report(report: dict):
+    print(f"{report['completed']}/{report['updates']} updates in {report['elapsed_seconds']:.2f}s, {report['messages_per_second']:.1f} msg/s")
+    print(f"{'kind':>6} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for kind, stats in report['latency'].items():
+        print(f"{kind:>6} {stats['count']:>6} {stats['p50'] * 1000:>8.1f} {stats['p95'] * 1000:>8.1f} {stats['p99'] * 1000:>8.1f} {stats['max'] * 1000:>8.1f}")
+    lag = report['loop_lag']
+    print(f"Event loop lag: p50 {lag['p50'] * 1000:.2f} ms, p99 {lag['p99'] * 1000:.2f} ms, max {lag['max'] * 1000:.2f} ms")
+    rss = report['rss_mb']
+    print(f"RSS: {rss['start']:.1f} MB at start, {rss['end']:.1f} MB at end, {rss['peak']:.1f} MB peak")
+    print(f"Gemini: {json.dumps(report['gemini'])}")
+    print(f"Telegram calls: {json.dumps(report['telegram_calls'])}")
+    if report['counters']:
+        print(f"Counters: {json.dumps(report['counters'])}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the bot offline against stub Telegram and Gemini backends.")
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--mix', default="text=0.8,photo=0.15,voice=0.05", help="Relative weights of text, photo and voice messages.")
+    parser.add_argument('--burst', type=int, default=3, help="Maximum messages a user sends back to back.")
+    parser.add_argument('--burst-gap', type=float, default=0.5, help="Mean seconds between messages inside a burst.")
+    parser.add_argument('--think-time', type=float, default=20, help="Mean seconds between a user's bursts.")
+    parser.add_argument('--album-rate', type=float, default=0.1, help="Fraction of photos sent as albums of 2-10 images.")
+    parser.add_argument('--gemini-latency', type=float, default=0.6, help="Mean seconds to the first token.")
+    parser.add_argument('--gemini-jitter', type=float, default=0.2)
+    parser.add_argument('--tokens-per-second', type=float, default=150)
+    parser.add_argument('--reply-tokens', type=int, default=250)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of Gemini calls failing with an unavailable error.")
+    parser.add_argument('--quota-rate', type=float, default=0.0, help="Fraction of Gemini calls failing with a quota error.")
+    parser.add_argument('--blocked-rate', type=float, default=0.0, help="Fraction of prompts reported as blocked.")
+    parser.add_argument('--model-latency', action='append', metavar='MODEL=SECONDS', help="Override the first-token latency of one model, e.g. to make it slow for hedging.")
+    parser.add_argument('--model-error-rate', action='append', metavar='MODEL=RATE', help="Override the unavailable-error rate of one model, e.g. to trip its circuit breaker.")
+    parser.add_argument('--upload-latency', type=float, default=0.2, help="Seconds per stub Gemini file upload.")
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help="Seconds per stub Bot API call.")
+    parser.add_argument('--photo-size', type=int, default=1280, help="Side in pixels of the JPEG served for photo downloads.")
+    parser.add_argument('--whitelist', action='store_true', help="Put the synthetic users on the rate-limit whitelist.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help="Directory for history and rate-limit files (default: a fresh temporary directory).")
+    parser.add_argument('--dump-updates', help="Also write the generated updates to this JSONL file for replay_updates.py.")
+    parser.add_argument('--json', help="Write the report to this JSON file.")
+    args = parser.parse_args()
+
+    updates = generate_updates(args.users, args.messages, parse_mix(args.mix), args.burst, args.burst_gap, args.think_time, args.album_rate, args.seed)
+    if args.dump_updates:
+        with open(args.dump_updates, 'w', encoding='utf-8') as f:
+            for _, data in updates:
+                f.write(json.dumps(data) + "\n")
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    bot, replay = load_bot(args.workdir or tempfile.mkdtemp(prefix='loadtest-'))
+    backend = StubGemini(args.gemini_latency, args.gemini_jitter, args.tokens_per_second, args.reply_tokens,
+                         args.error_rate, args.quota_rate, args.blocked_rate, args.upload_latency, args.seed,
+                         parse_model_values(args.model_latency), parse_model_values(args.model_error_rate))
+    install_stubs(bot, backend)
+    if args.whitelist:
+        bot.RATE_LIMIT_WHITELIST.update(BASE_USER_ID + index for index in range(args.users))
+    bot.logger.setLevel(os.getenv("LOADTEST_LOG_LEVEL", "WARNING"))
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    report = asyncio.run(run_load(bot, replay, updates, backend, args.telegram_latency, args.photo_size))
+    print_report(report)
+    if json_path:
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from io import BytesIO
+from urllib.parse import parse_qs, urlparse
+
+import httpx
+from dotenv import load_dotenv
+from PIL import Image
+from telegram.request import BaseRequest
+
+load_dotenv()
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:replay")
+os.environ.setdefault("GEMINI_API_KEY", "replay")
+os.environ.setdefault("ADMIN_USER_ID", "1")
+
+import bot
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Replay Bot", "username": "replay_bot", "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+MESSAGE_METHODS = {"sendMessage", "editMessageText", "sendPhoto", "sendVoice", "sendDocument"}
+
+def placeholder_jpeg(size: int = 64) -> bytes:
+    buffer = BytesIO()
+    Image.effect_noise((size, size), 64).convert('RGB').save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+class FakeBotApi:
+    def __init__(self, media_dir: str = None, photo_size: int = 64, record: bool = True):
+        self.media_dir = media_dir
+        self.record = record
+        self.calls = []
+        self.method_counts = {}
+        self.next_message_id = 1000
+        self.placeholder = placeholder_jpeg(photo_size)
+
+    def call(self, method: str, params: dict):
+        self.method_counts[method] = self.method_counts.get(method, 0) + 1
+        if self.record:
+            self.calls.append({"time": time.time(), "method": method, "params": params})
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return []
+        if method == "getFile":
+            file_id = params["file_id"]
+            return {"file_id": file_id, "file_unique_id": file_id[-16:], "file_size": len(self.placeholder), "file_path": f"replay/{file_id}"}
+        if method in MESSAGE_METHODS:
+            message_id = params.get("message_id")
+            if message_id is None:
+                self.next_message_id += 1
+                message_id = self.next_message_id
+            return {
+                "message_id": int(message_id),
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        return True
+
+    def file_content(self, file_path: str) -> bytes:
+        if self.media_dir:
+            path = os.path.join(self.media_dir, os.path.basename(file_path))
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    return f.read()
+        return self.placeholder
+
+    def response(self, method: str, params: dict) -> bytes:
+        return json.dumps({"ok": True, "result": self.call(method, params)}).encode()
+
+class ReplayRequest(BaseRequest):
+    def __init__(self, api: FakeBotApi):
+        self.api = api
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if '/file/bot' in url:
+            return 200, self.api.file_content(url)
+        params = request_data.parameters if request_data else {}
+        return 200, self.api.response(url.rsplit('/', 1)[-1], params)
+
+def file_transport(api: FakeBotApi, latency: float = 0) -> httpx.MockTransport:
+    async def handle(request: httpx.Request) -> httpx.Response:
+        if latency:
+            await asyncio.sleep(latency)
+        return httpx.Response(200, content=api.file_content(request.url.path))
+
+    return httpx.MockTransport(handle)
+
+def read_updates(path: str) -> list:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+async def wait_until_idle(application):
+    while application.update_queue.qsize() or bot.lifecycle.in_flight or bot.lifecycle.background_tasks:
+        await asyncio.sleep(0.05)
+
+async def replay_in_process(updates: list, api: FakeBotApi):
+    application = bot.build_application(request=ReplayRequest(api))
+    bot.file_downloader.transport = file_transport(api)
+    async with application:
+        await bot.post_init(application)
+        await application.start()
+        for data in updates:
+            await application.update_queue.put(bot.Update.de_json(data, application.bot))
+        await wait_until_idle(application)
+        await application.stop()
+    await bot.post_shutdown(application)
+
+async def replay_to_receiver(updates: list, url: str, secret: str):
+    target = urlparse(url)
+    connection = bot.HttpConnection(target.hostname, target.port or 80)
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else None
+    for data in updates:
+        body = json.dumps(data).encode()
+        status, _ = await connection.request('POST', target.path or '/', body, headers=headers)
+        print(json.dumps({"update_id": data.get("update_id"), "status": status}))
+    connection.close()
+
+async def serve_fake_api(port: int, api: FakeBotApi):
+    async def handle(method, path, headers, body):
+        if '/file/bot' in path:
+            return 200, 'application/octet-stream', api.file_content(path)
+        if headers.get('content-type', '').startswith('application/json'):
+            params = json.loads(body or b'{}')
+        else:
+            params = {}
+            for name, values in parse_qs(body.decode()).items():
+                try:
+                    params[name] = json.loads(values[0])
+                except ValueError:
+                    params[name] = values[0]
+        api_method = path.rsplit('/', 1)[-1]
+        print(json.dumps({"method": api_method, "params": params}, ensure_ascii=False), flush=True)
+        return 200, 'application/json', api.response(api_method, params)
+
+    await bot.serve_http('127.0.0.1', port, handle)
+    print(f"Fake Bot API listening; start workers with TELEGRAM_BASE_URL=http://127.0.0.1:{port}/bot and TELEGRAM_BASE_FILE_URL=http://127.0.0.1:{port}/file/bot", file=sys.stderr)
+    await asyncio.Event().wait()
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded Telegram updates against the bot without contacting Telegram.")
+    parser.add_argument('updates', nargs='?', help="JSONL file with one Telegram update object per line.")
+    parser.add_argument('--url', help="Post the updates to a running webhook receiver instead of an in-process bot.")
+    parser.add_argument('--secret', default=bot.WEBHOOK_SECRET_TOKEN, help="Secret token header for --url.")
+    parser.add_argument('--serve-api', type=int, metavar='PORT', help="Run a fake Bot API server for webhook workers instead of replaying.")
+    parser.add_argument('--media-dir', help="Directory with files named after file_ids to serve for downloads.")
+    parser.add_argument('--output', help="Write the recorded Bot API calls to this JSONL file.")
+    args = parser.parse_args()
+
+    api = FakeBotApi(args.media_dir)
+    if args.serve_api:
+        asyncio.run(serve_fake_api(args.serve_api, api))
+        return
+    if not args.updates:
+        parser.error("an updates file is required unless --serve-api is used")
+
+    updates = read_updates(args.updates)
+    if args.url:
+        asyncio.run(replay_to_receiver(updates, args.url, args.secret))
+        return
+
+    asyncio.run(replay_in_process(updates, api))
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    for call in api.calls:
+        output.write(json.dumps(call, ensure_ascii=False, default=str) + "\n")
+    if args.output:
+        output.close()
+
+if __name__ == '__main__':
+    main()